@@ -1,9 +1,26 @@
 import argparse
+import json
 import sys
 
 from mmt import utils
 from mmt.checkpoint import CheckpointRegistry
 from mmt.decoder import MMTDecoder, ModelConfig
+from mmt.workers import DecoderWorkers
+
+
+def _check_int8(decoder, args, stdout):
+    source_lang, target_lang, path = args.calibrate_int8 or args.check_int8
+    with open(path, 'r', encoding='utf-8') as f:
+        segments = [line.strip() for line in f]
+
+    if args.calibrate_int8 is not None:
+        excluded, errors = decoder.calibrate_int8(source_lang, target_lang, segments, max_error=args.int8_max_error)
+        result = {'excluded': excluded, 'errors': errors}
+    else:
+        result = decoder.check_int8(source_lang, target_lang, segments)
+
+    stdout.write(json.dumps(result, indent=2) + '\n')
+    stdout.flush()
 
 
 def main(argv=None):
@@ -14,6 +31,21 @@ def main(argv=None):
     parser.add_argument('-l', '--log-level', dest='log_level', metavar='LEVEL', help='select the log level',
                         choices=['critical', 'error', 'warning', 'info', 'debug'], default='info')
     parser.add_argument('-g', '--gpu', dest='gpu', help='specify the GPU to use (default none)', default=None, type=int)
+    parser.add_argument('--pipelined', dest='pipelined', action='store_true', default=False,
+                        help='overlap request parsing, subword encoding and response serialization with decoding')
+    parser.add_argument('-w', '--workers', dest='workers', metavar='N', default=1, type=int,
+                        help='fork N CPU decoder workers sharing the same weights (default 1, ignored with --gpu)')
+    parser.add_argument('--threads', dest='threads', metavar='N', default=None, type=int,
+                        help='number of threads of each worker (default: the number of cores divided by workers)')
+    parser.add_argument('--pack', dest='pack', metavar='PATH', default=None,
+                        help='write a deployment bundle of MODEL in PATH (loadable as a MODEL) and exit')
+    parser.add_argument('--calibrate-int8', dest='calibrate_int8', nargs=3, metavar=('SRC', 'TGT', 'FILE'),
+                        default=None, help='calibrate the int8 quantization of the SRC > TGT checkpoint with the '
+                                           'sentences in FILE, print the error of every layer and exit')
+    parser.add_argument('--int8-max-error', dest='int8_max_error', metavar='E', default=0.05, type=float,
+                        help='layers with a greater relative error are not quantized (calibration, default 0.05)')
+    parser.add_argument('--check-int8', dest='check_int8', nargs=3, metavar=('SRC', 'TGT', 'FILE'), default=None,
+                        help='translate the sentences in FILE both in float and int8, print a comparison and exit')
 
     args = parser.parse_args(argv)
 
@@ -31,17 +63,42 @@ def main(argv=None):
         config = ModelConfig.load(args.model)
 
         builder = CheckpointRegistry.Builder()
-        for name, checkpoint_path in config.checkpoints:
-            builder.register(name, checkpoint_path)
-        checkpoints = builder.build(args.gpu)
+        if CheckpointRegistry.is_bundle(args.model):
+            builder.register_bundle(args.model)
+        else:
+            for name, checkpoint_path in config.checkpoints:
+                builder.register(name, checkpoint_path)
+
+        if args.pack is not None:
+            builder.pack(args.pack)
+            config.save(args.pack, checkpoints=False)  # checkpoints are listed in the bundle manifest
+            return
+
+        checkpoints = builder.build(args.gpu, lazy=config.decoder.decoder_lazy_checkpoints,
+                                    max_memory_mb=config.decoder.decoder_checkpoints_memory_mb)
+
+        if args.calibrate_int8 is not None or args.check_int8 is not None:
+            decoder_ops = config.decoder
+            decoder_ops.decoder_int8 = True
+
+            decoder = MMTDecoder(checkpoints, tuning_ops=config.tuning, decoder_ops=decoder_ops)
+            _check_int8(decoder, args, stdout)
+            return
 
-        decoder = MMTDecoder(checkpoints, device=args.gpu, tuning_ops=config.tuning)
+        if args.gpu is None and args.workers > 1:
+            decoder = DecoderWorkers(checkpoints, args.workers, num_threads=args.threads,
+                                     tuning_ops=config.tuning, decoder_ops=config.decoder)
+        else:
+            decoder = MMTDecoder(checkpoints, device=args.gpu, tuning_ops=config.tuning, decoder_ops=config.decoder)
     except Exception as e:
         stdout.write('ERROR: %s\n' % str(e))
         stdout.flush()
         raise
 
-    utils.serve_forever(sys.stdin, stdout, decoder)
+    if args.pipelined:
+        utils.serve_pipelined(sys.stdin, stdout, decoder)
+    else:
+        utils.serve_forever(sys.stdin, stdout, decoder)
 
 
 if __name__ == '__main__':
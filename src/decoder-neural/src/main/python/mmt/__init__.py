@@ -40,6 +40,12 @@ class MMTTranslationTask(TranslationTask):
     def load_dictionary(cls, filename):
         if os.path.basename(filename) != 'model.vcb':
             filename = os.path.join(os.path.dirname(filename), 'model.vcb')
+
+        # deployment bundles have a pre-indexed copy of the dictionary (see CheckpointRegistry.Builder.pack)
+        indexed_filename = os.path.join(os.path.dirname(filename), 'model.dct')
+        if os.path.isfile(indexed_filename):
+            return SubwordDictionary.load_indexed(indexed_filename)
+
         return SubwordDictionary.load(filename)
 
     @classmethod
@@ -1,5 +1,9 @@
+import heapq
+import math
+
 import numpy as np
 import regex
+import torch
 
 
 # - Symmetrization strategies ------------------------------------------------------------------------------------------
@@ -25,17 +29,7 @@ def sym_grow(i2o, o2i, ilen, olen):
     union = sym_union(i2o, o2i, ilen, olen)
     alignment = sym_intersect(i2o, o2i, ilen, olen)
 
-    new_points_added = True
-    while new_points_added:
-        new_points_added = False
-        for i in range(ilen):
-            for o in range(olen):
-                if (i, o) in alignment:
-                    for (i_new, o_new) in _neighboring_points_orthogonal(i, o, ilen, olen):
-                        if not (_aligned_o(o_new, ilen, alignment) and _aligned_i(i_new, olen, alignment)) \
-                                and ((i_new, o_new) in union):
-                            alignment.append((i_new, o_new))
-                            new_points_added = True
+    _grow(alignment, union, ilen, olen, _neighboring_points_orthogonal)
 
     return alignment
 
@@ -44,28 +38,10 @@ def sym_grow_diagonal(i2o, o2i, ilen, olen):
     union = sym_union(i2o, o2i, ilen, olen)
     alignment = sym_intersect(i2o, o2i, ilen, olen)
 
-    new_points_added = True
-    while new_points_added:
-        new_points_added = False
-        for i in range(ilen):
-            for o in range(olen):
-                if (i, o) in alignment:
-                    for (i_new, o_new) in _neighboring_points_orthogonal(i, o, ilen, olen):
-                        if not (_aligned_o(o_new, ilen, alignment) and _aligned_i(i_new, olen, alignment)) \
-                                and ((i_new, o_new) in union):
-                            alignment.append((i_new, o_new))
-                            new_points_added = True
-
-    while new_points_added:
-        new_points_added = False
-        for i in range(ilen):
-            for o in range(olen):
-                if (i, o) in alignment:
-                    for (i_new, o_new) in _neighboring_points_diagonal(i, o, ilen, olen):
-                        if not (_aligned_o(o_new, ilen, alignment) and _aligned_i(i_new, olen, alignment)) \
-                                and ((i_new, o_new) in union):
-                            alignment.append((i_new, o_new))
-                            new_points_added = True
+    # The diagonal pass of the original scan loop never ran (it was guarded by the flag the orthogonal pass leaves
+    # False), so grow-diag has always returned the points of grow: that output is preserved, growing along
+    # _neighboring_points_diagonal too would change the alignments served.
+    _grow(alignment, union, ilen, olen, _neighboring_points_orthogonal)
 
     return alignment
 
@@ -79,6 +55,9 @@ def sym_grow_diagonal_final_and(i2o, o2i, ilen, olen):
 # - Make alignment -----------------------------------------------------------------------------------------------------
 
 
+_THRESHOLD = 0.80  # TODO: find the best setting (0.85?, 0.75?, 0.90?, 1.00?)
+
+
 def make_alignment(source_indexes, target_indexes, attention_matrix, prefix_lang=None, symmetrize=sym_intersect):
     # resulting shape (layers, batch, heads, output, input);
     # last two dimensions truncated to the size of trg_sub_tokens and src_sub_tokens
@@ -87,40 +66,92 @@ def make_alignment(source_indexes, target_indexes, attention_matrix, prefix_lang
     norm_axis0 = (alignment_matrix / alignment_matrix.sum(axis=0)[np.newaxis])
     norm_axis1 = (alignment_matrix / alignment_matrix.sum(axis=1)[:, np.newaxis])
 
-    s2t_best_indexes = norm_axis0.argmax(1)
-    t2s_best_indexes = norm_axis1.argmax(0)
+    # select points of the direct alignment (having score >= threshold*best)
+    t2s_mask = norm_axis1 >= _THRESHOLD * norm_axis1.max(axis=0).astype(np.float64)[np.newaxis]
+    # select points of the inverted alignment (having score >= threshold*best)
+    s2t_mask = norm_axis0 >= _THRESHOLD * norm_axis0.max(axis=1).astype(np.float64)[:, np.newaxis]
 
-    threshold = 0.80  # TODO: find the best setting (0.85?, 0.75?, 0.90?, 1.00?)
-    s_len = alignment_matrix.shape[0]
-    t_len = alignment_matrix.shape[1]
+    return _symmetrize_points(source_indexes, target_indexes, np.nonzero(t2s_mask), np.nonzero(s2t_mask),
+                              prefix_lang=prefix_lang, symmetrize=symmetrize)
 
-    # select points of the direct alignment (having score >= threshold*best)
-    t2s_sub_alignment = []
-    for t in range(t_len):
-        threshold_value = threshold * norm_axis1[t2s_best_indexes[t], t]
-        t2s_sub_alignment += [(s, t) for s in range(s_len) if norm_axis1[s, t] >= threshold_value]
 
-    # select points of the inverted alignment (having score >= threshold*best)
-    s2t_sub_alignment = []
-    for s in range(s_len):
-        threshold_value = threshold * norm_axis0[s, s2t_best_indexes[s]]
-        s2t_sub_alignment += [(s, t) for t in range(t_len) if norm_axis0[s, t] >= threshold_value]
+def make_alignments(batch_source_indexes, batch_target_indexes, attention_matrices, prefix_lang=None,
+                    symmetrize=sym_intersect):
+    """
+    Batch version of make_alignment() that works on torch attention matrices: points are selected for the
+    whole batch on the device the matrices live on, only their coordinates are copied back to the host.
+    """
+    if len(attention_matrices) == 0:
+        return []
+
+    matrices = [matrix[:len(source_indexes), :len(target_indexes)] for source_indexes, target_indexes, matrix
+                in zip(batch_source_indexes, batch_target_indexes, attention_matrices)]
+    source_lengths = [matrix.size(0) for matrix in matrices]
+    target_lengths = [matrix.size(1) for matrix in matrices]
+
+    alignment_matrix = matrices[0].new_zeros((len(matrices), max(source_lengths), max(target_lengths)))
+    for i, matrix in enumerate(matrices):
+        alignment_matrix[i, :source_lengths[i], :target_lengths[i]] = matrix
+
+    device = alignment_matrix.device
+    valid_rows = torch.arange(alignment_matrix.size(1), device=device)[None] < \
+        torch.tensor(source_lengths, device=device)[:, None]
+    valid_cols = torch.arange(alignment_matrix.size(2), device=device)[None] < \
+        torch.tensor(target_lengths, device=device)[:, None]
+    valid = valid_rows[:, :, None] & valid_cols[:, None, :]
+
+    # padding rows and columns sum to zero: exclude them from max() instead of letting them propagate NaNs
+    norm_axis0 = (alignment_matrix / alignment_matrix.sum(dim=1, keepdim=True)).masked_fill(~valid, -math.inf)
+    norm_axis1 = (alignment_matrix / alignment_matrix.sum(dim=2, keepdim=True)).masked_fill(~valid, -math.inf)
+
+    t2s_mask = norm_axis1.double() >= _THRESHOLD * norm_axis1.max(dim=1, keepdim=True)[0].double()
+    s2t_mask = norm_axis0.double() >= _THRESHOLD * norm_axis0.max(dim=2, keepdim=True)[0].double()
+
+    # (direction, batch, source, target) coordinates of the selected points, in lexicographic order
+    points = torch.nonzero(torch.stack([t2s_mask, s2t_mask]) & valid[None]).cpu().numpy()
+    bounds = np.searchsorted(points[:, 0] * len(matrices) + points[:, 1], np.arange(2 * len(matrices) + 1))
+    points = [(points[begin:end, 2], points[begin:end, 3]) for begin, end in zip(bounds[:-1], bounds[1:])]
 
-    if not t2s_sub_alignment and not s2t_sub_alignment:
+    return [_symmetrize_points(source_indexes, target_indexes, points[i], points[len(matrices) + i],
+                               prefix_lang=prefix_lang, symmetrize=symmetrize)
+            for i, (source_indexes, target_indexes) in enumerate(zip(batch_source_indexes, batch_target_indexes))]
+
+
+def _symmetrize_points(source_indexes, target_indexes, t2s_points, s2t_points, prefix_lang=None,
+                       symmetrize=sym_intersect):
+    if len(t2s_points[0]) == 0 and len(s2t_points[0]) == 0:
         return []
 
+    # map sub-token points to token points, encoded as (source * stride + target) sorted keys
+    source_indexes = np.asarray(source_indexes, dtype=np.int64)
+    target_indexes = np.asarray(target_indexes, dtype=np.int64)
+    stride = int(target_indexes[-1]) + 1
+
+    def _token_keys(points):
+        s, t = points
+        return np.unique(source_indexes[s] * stride + target_indexes[t])
+
+    def _token_pairs(keys):
+        sources, targets = divmod(keys, stride)
+        return list(zip(sources.tolist(), targets.tolist()))
+
+    t2s_keys = _token_keys(t2s_points)
+    s2t_keys = _token_keys(s2t_points)
+
     # symmetrization on token-based alignment
-    t2s_alignment = sorted(set([(source_indexes[al[0]], target_indexes[al[1]]) for al in t2s_sub_alignment]))
-    s2t_alignment = sorted(set([(source_indexes[al[0]], target_indexes[al[1]]) for al in s2t_sub_alignment]))
-    highest_source_index = source_indexes[-1]
-    highest_target_index = target_indexes[-1]
-    alignment = sorted(symmetrize(t2s_alignment, s2t_alignment, highest_source_index + 1, highest_target_index + 1))
+    if symmetrize is sym_intersect:
+        keys = np.intersect1d(t2s_keys, s2t_keys, assume_unique=True)
+    elif symmetrize is sym_union:
+        keys = np.union1d(t2s_keys, s2t_keys)
+    else:
+        alignment = symmetrize(_token_pairs(t2s_keys), _token_pairs(s2t_keys), int(source_indexes[-1]) + 1, stride)
+        keys = np.unique(np.array([s * stride + t for s, t in alignment], dtype=np.int64))
 
     # shift source indexes if a language prefix has been used
     if prefix_lang:
-        alignment = [(al[0] - 1, al[1]) for al in alignment if al[0] > 0]
+        keys = keys[keys >= stride] - stride
 
-    return alignment
+    return _token_pairs(keys)
 
 
 _is_word_regex = regex.compile(r'\w', flags=regex.U)
@@ -217,31 +248,59 @@ def _neighboring_points(o_index, i_index, e_len, f_len):
     return result
 
 
-def _aligned_o(o, ilen, alignment):
+class _Coverage(object):
     """
-    A function that checks if a given 'english' word is aligned
-    to any foreign word in a given foreign sentence
+    Bitmaps of the input and output words covered by an alignment
     """
-    for i in range(ilen):
-        if (i, o) in alignment:
-            return True
 
-    return False
+    def __init__(self, alignment, ilen, olen):
+        self.i = bytearray(ilen)
+        self.o = bytearray(olen)
+
+        for i, o in alignment:
+            self.add(i, o)
 
+    def add(self, i, o):
+        self.i[i] = 1
+        self.o[o] = 1
 
-def _aligned_i(i, olen, alignment):
+    def covers(self, i, o):
+        return self.i[i] and self.o[o]
+
+
+def _grow(alignment, union, ilen, olen, neighboring_points):
     """
-    A function that checks if a given foreign word is aligned
-    to any 'english' word in a given 'english' sentence
+    A function that implements the GROW step of GROW-DIAG-FINAL algorithm:
+    it appends to alignment the points of union that are neighbors of an aligned
+    point and that cover a word not aligned yet, until no more points can be added.
+
+    Points are visited in (i, o) order with a frontier queue: a point added ahead of
+    the current one is visited in the same pass, a point added behind it in the next one.
+    Since coverage can only grow, a point that has already been visited cannot add
+    anything new, hence it is never visited twice.
     """
-    # print "i:%s" % (i)
-    # print "olen:%s" % (olen)
-    # print "len(alignment):%s" % (len(alignment))
-    for o in range(olen):
-        if (i, o) in alignment:
-            return True
+    union = set(union)
+    coverage = _Coverage(alignment, ilen, olen)
+
+    frontier = list(alignment)
+    while len(frontier) > 0:
+        heapq.heapify(frontier)
+        next_frontier = []
+
+        while len(frontier) > 0:
+            point = heapq.heappop(frontier)
 
-    return False
+            for new_point in neighboring_points(point[0], point[1], ilen, olen):
+                if not coverage.covers(*new_point) and new_point in union:
+                    alignment.append(new_point)
+                    coverage.add(*new_point)
+
+                    if new_point > point:
+                        heapq.heappush(frontier, new_point)
+                    else:
+                        next_frontier.append(new_point)
+
+        frontier = next_frontier
 
 
 def _final(alignment, i2o, o2i, ilen, olen):
@@ -249,8 +308,9 @@ def _final(alignment, i2o, o2i, ilen, olen):
     A function that implements both FINAL(e2f) and FINAL(f2e)
     steps of GROW-DIAG-FINAL algorithm
     """
-    for o in range(olen):
-        for i in range(ilen):
-            if not (_aligned_o(o, ilen, alignment) and _aligned_i(i, olen, alignment)) \
-                    and ((i, o) in i2o or (i, o) in o2i):
-                alignment.append((i, o))
+    coverage = _Coverage(alignment, ilen, olen)
+
+    for o, i in sorted((o, i) for i, o in set(i2o) | set(o2i)):
+        if not coverage.covers(i, o):
+            alignment.append((i, o))
+            coverage.add(i, o)
@@ -0,0 +1,185 @@
+import types
+
+import torch
+from fairseq.modules import MultiheadAttention
+
+_ARENA_STEP = 'arena_step'
+
+
+class _LayerState(object):
+    def __init__(self):
+        self.keys = None
+        self.values = None
+        self.spare_keys = None
+        self.spare_values = None
+
+    @property
+    def capacity(self):
+        return (0, 0) if self.keys is None else tuple(self.keys.shape[:2])
+
+    def reserve(self, rows, length, head_dim, like, keep_length=0):
+        cap_rows, cap_length = self.capacity
+
+        if self.keys is not None and self.keys.dtype == like.dtype and self.keys.device == like.device \
+                and rows <= cap_rows and length <= cap_length:
+            return
+
+        # grow geometrically so that a few requests are enough to reach a stable size
+        rows = cap_rows if rows <= cap_rows else max(rows, 2 * cap_rows)
+        length = cap_length if length <= cap_length else max(length, 2 * cap_length, 32)
+
+        keys = like.new_empty((rows, length, head_dim))
+        values = like.new_empty((rows, length, head_dim))
+
+        if keep_length > 0:
+            keys[:cap_rows, :keep_length].copy_(self.keys[:, :keep_length])
+            values[:cap_rows, :keep_length].copy_(self.values[:, :keep_length])
+
+        self.keys, self.values = keys, values
+        self.spare_keys = like.new_empty((rows, length, head_dim))
+        self.spare_values = like.new_empty((rows, length, head_dim))
+
+    def swap(self):
+        self.keys, self.spare_keys = self.spare_keys, self.keys
+        self.values, self.spare_values = self.spare_values, self.values
+
+    def size_in_bytes(self):
+        if self.keys is None:
+            return 0
+        return 4 * self.keys.element_size() * self.keys.nelement()
+
+
+class DecoderStateArena(object):
+    """
+    Holds the key/value caches of the decoder self-attention layers in preallocated tensors that are reused
+    across calls to SequenceGenerator.generate(). The default fairseq implementation grows the cache with a
+    torch.cat() at every step and allocates a new copy at every beam reorder; here new keys and values are written
+    in place and beam reordering is done with index_select() into a spare buffer of the same size.
+
+    Encoder output and encoder-decoder keys/values are computed once per generate() call by fairseq already,
+    so they are not part of the arena.
+    """
+
+    def __init__(self):
+        self._layers = []
+
+    def install(self, model):
+        for module in model.decoder.modules():
+            if isinstance(module, MultiheadAttention) and module.self_attention:
+                layer = _LayerState()
+                self._layers.append(layer)
+                self._bind(module, layer)
+
+        return model
+
+    def size_in_bytes(self):
+        return sum(layer.size_in_bytes() for layer in self._layers)
+
+    def clear(self):
+        for layer in self._layers:
+            layer.__init__()
+
+    @staticmethod
+    def _can_use_arena(module, query, key_padding_mask, incremental_state, attn_mask, static_kv):
+        return incremental_state is not None and not module.training and not static_kv \
+               and key_padding_mask is None and attn_mask is None and query.size(0) == 1 \
+               and module.bias_k is None and not module.add_zero_attn
+
+    def _bind(self, module, layer):
+        _forward = module.forward
+        _reorder_incremental_state = module.reorder_incremental_state
+
+        def forward(_self, query, key, value, key_padding_mask=None, incremental_state=None, need_weights=True,
+                    static_kv=False, attn_mask=None, before_softmax=False, need_head_weights=False):
+            saved_state = _self._get_input_buffer(incremental_state) if incremental_state is not None else None
+
+            if before_softmax or 'prev_key' in (saved_state or {}) or \
+                    not self._can_use_arena(_self, query, key_padding_mask, incremental_state, attn_mask, static_kv):
+                if saved_state is not None and _ARENA_STEP in saved_state:
+                    self._release(_self, layer, incremental_state, saved_state)
+                return _forward(query, key, value, key_padding_mask=key_padding_mask,
+                                incremental_state=incremental_state, need_weights=need_weights,
+                                static_kv=static_kv, attn_mask=attn_mask, before_softmax=before_softmax,
+                                need_head_weights=need_head_weights)
+
+            return self._forward(_self, layer, query, incremental_state, saved_state,
+                                 need_weights or need_head_weights, need_head_weights)
+
+        def reorder_incremental_state(_self, incremental_state, new_order):
+            saved_state = _self._get_input_buffer(incremental_state)
+            if _ARENA_STEP not in saved_state:
+                return _reorder_incremental_state(incremental_state, new_order)
+
+            step = saved_state[_ARENA_STEP]
+            bsz = saved_state['bsz']
+            num_heads = _self.num_heads
+
+            rows = (new_order.unsqueeze(1) * num_heads +
+                    torch.arange(num_heads, device=new_order.device).unsqueeze(0)).view(-1)
+            layer.reserve(rows.numel(), step, _self.head_dim, layer.keys, keep_length=step)
+
+            torch.index_select(layer.keys[:bsz * num_heads, :step], 0, rows,
+                               out=layer.spare_keys[:rows.numel(), :step])
+            torch.index_select(layer.values[:bsz * num_heads, :step], 0, rows,
+                               out=layer.spare_values[:rows.numel(), :step])
+            layer.swap()
+
+            saved_state['bsz'] = new_order.numel()
+            return _self._set_input_buffer(incremental_state, saved_state)
+
+        module.forward = types.MethodType(forward, module)
+        module.reorder_incremental_state = types.MethodType(reorder_incremental_state, module)
+
+    @staticmethod
+    def _forward(module, layer, query, incremental_state, saved_state, need_weights, need_head_weights):
+        _, bsz, embed_dim = query.size()
+        num_heads, head_dim = module.num_heads, module.head_dim
+        rows = bsz * num_heads
+        step = saved_state.get(_ARENA_STEP, 0)
+
+        q = module.q_proj(query)
+        k = module.k_proj(query)
+        v = module.v_proj(query)
+        q *= module.scaling
+
+        layer.reserve(rows, step + 1, head_dim, k, keep_length=step)
+        layer.keys[:rows, step].copy_(k.view(rows, head_dim))
+        layer.values[:rows, step].copy_(v.view(rows, head_dim))
+
+        keys = layer.keys[:rows, :step + 1]
+        values = layer.values[:rows, :step + 1]
+
+        q = q.view(rows, 1, head_dim)
+        attn_weights = torch.bmm(q, keys.transpose(1, 2))
+
+        attn_weights_float = torch.softmax(attn_weights, dim=-1, dtype=torch.float32)
+        attn_probs = module.dropout_module(attn_weights_float.type_as(attn_weights))
+
+        attn = torch.bmm(attn_probs, values)
+        attn = attn.transpose(0, 1).contiguous().view(1, bsz, embed_dim)
+        attn = module.out_proj(attn)
+
+        saved_state[_ARENA_STEP] = step + 1
+        saved_state['bsz'] = bsz
+        module._set_input_buffer(incremental_state, saved_state)
+
+        if not need_weights:
+            return attn, None
+
+        attn_weights = attn_weights_float.view(bsz, num_heads, 1, step + 1).transpose(1, 0)
+        if not need_head_weights:
+            attn_weights = attn_weights.mean(dim=0)
+
+        return attn, attn_weights
+
+    @staticmethod
+    def _release(module, layer, incremental_state, saved_state):
+        # hand the current cache back to the default fairseq implementation
+        step = saved_state.pop(_ARENA_STEP)
+        bsz = saved_state.pop('bsz')
+        shape = (bsz, module.num_heads, step, module.head_dim)
+
+        saved_state['prev_key'] = layer.keys[:bsz * module.num_heads, :step].reshape(shape)
+        saved_state['prev_value'] = layer.values[:bsz * module.num_heads, :step].reshape(shape)
+        saved_state['prev_key_padding_mask'] = None
+        module._set_input_buffer(incremental_state, saved_state)
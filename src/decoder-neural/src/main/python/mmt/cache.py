@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import cachetools
+
+
+class TranslationStore(object):
+    """
+    Persistent store of translations in a SQLite database, used by TranslationCache for the entries not in memory:
+    it survives restarts and it is bounded by max_entries (the least recently used entries are deleted).
+    Entries are keyed on the files of the checkpoint (path, size and modification time) and on a signature of the
+    decoder settings, so that they are not served after the model or the settings have been changed.
+    """
+
+    _EVICTION_INTERVAL = 1000
+
+    def __init__(self, path, translation_class, max_entries=None, signature=None):
+        self._translation_class = translation_class
+        self._max_entries = max_entries
+        self._signature = signature
+        self._fingerprints = {}
+        self._puts = 0
+        self._lock = threading.Lock()
+
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+
+        with self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, '
+                                     'text TEXT NOT NULL, alignment TEXT, score REAL, accessed REAL NOT NULL)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS translations_accessed ON translations (accessed)')
+
+    def _fingerprint(self, checkpoint):
+        if checkpoint not in self._fingerprints:
+            files = []
+            for filename in sorted(os.listdir(checkpoint.path)):
+                if filename.startswith('model.'):
+                    stat = os.stat(os.path.join(checkpoint.path, filename))
+                    files.append((filename, stat.st_size, stat.st_mtime_ns))
+
+            self._fingerprints[checkpoint] = [os.path.abspath(checkpoint.path), files]
+
+        return self._fingerprints[checkpoint]
+
+    def _key(self, key):
+        checkpoint, *rest = key
+        data = json.dumps([self._signature, self._fingerprint(checkpoint)] + rest, ensure_ascii=False)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def get_all(self, keys):
+        store_keys = {self._key(key): key for key in keys}
+        result = {}
+
+        with self._lock, self._connection:
+            store_keys_list = list(store_keys)
+            for begin in range(0, len(store_keys_list), 500):
+                chunk = store_keys_list[begin:begin + 500]
+                rows = self._connection.execute('SELECT key, text, alignment, score FROM translations WHERE key IN '
+                                                '(%s)' % ','.join('?' * len(chunk)), chunk).fetchall()
+
+                for store_key, text, alignment, score in rows:
+                    alignment = [tuple(point) for point in json.loads(alignment)] if alignment is not None else None
+                    result[store_keys[store_key]] = self._translation_class(text, alignment=alignment, score=score)
+
+                now = time.time()
+                self._connection.executemany('UPDATE translations SET accessed = ? WHERE key = ?',
+                                             [(now, row[0]) for row in rows])
+
+        return result
+
+    def put_all(self, items):
+        now = time.time()
+        rows = [(self._key(key), translation.text,
+                 json.dumps([[int(i), int(j)] for i, j in translation.alignment])
+                 if translation.alignment is not None else None,
+                 translation.score, now) for key, translation in items]
+
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR IGNORE INTO translations VALUES (?, ?, ?, ?, ?)', rows)
+            # a translation with alignment replaces one without it, not vice versa
+            self._connection.executemany('UPDATE translations SET text = ?, alignment = ?, score = ?, accessed = ? '
+                                         'WHERE key = ? AND alignment IS NULL',
+                                         [row[1:] + row[:1] for row in rows if row[2] is not None])
+
+            self._puts += len(rows)
+            if self._max_entries is not None and self._puts >= self._EVICTION_INTERVAL:
+                self._puts = 0
+                self._evict()
+
+    def _evict(self):
+        count = self._connection.execute('SELECT COUNT(*) FROM translations').fetchone()[0]
+        if count > self._max_entries:
+            self._connection.execute('DELETE FROM translations WHERE key IN '
+                                     '(SELECT key FROM translations ORDER BY accessed LIMIT ?)',
+                                     (count - self._max_entries,))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class TranslationCache(object):
+    """
+    Bounded LRU cache of the translations of plain requests (no suggestions, no forced translation), keyed on
+    checkpoint, language pair, beam size and the exact source segment. A translation cached with word alignment
+    also serves requests without it, not vice versa. With a TranslationStore, the entries not in memory are
+    looked up in the store (and the new ones are written to it too).
+    """
+
+    def __init__(self, max_size, store=None):
+        self._cache = cachetools.LRUCache(maxsize=max_size) if max_size else None
+        self._store = store
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._store_hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def key(checkpoint, source_lang, target_lang, segment, beam_size=None):
+        return checkpoint, source_lang, target_lang, beam_size or 0, segment
+
+    @property
+    def hits(self):
+        return self._hits
+
+    @property
+    def store_hits(self):
+        return self._store_hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    @property
+    def hit_rate(self):
+        total = self._hits + self._misses
+        return self._hits / total if total > 0 else 0.
+
+    def __len__(self):
+        return len(self._cache) if self._cache is not None else 0
+
+    def get_all(self, keys, alignment=True):
+        def usable(translation):
+            return translation is not None and (not alignment or translation.alignment is not None)
+
+        with self._lock:
+            translations = [self._cache.get(key) if self._cache is not None else None for key in keys]
+            translations = [translation if usable(translation) else None for translation in translations]
+
+        if self._store is not None:
+            missing = [key for key, translation in zip(keys, translations) if translation is None]
+            if len(missing) > 0:
+                stored = {key: translation for key, translation in self._store.get_all(missing).items()
+                          if usable(translation)}
+
+                with self._lock:
+                    for key, translation in stored.items():
+                        self._store_hits += 1
+                        self._put(key, translation)
+
+                translations = [translation if translation is not None else stored.get(key)
+                                for key, translation in zip(keys, translations)]
+
+        with self._lock:
+            # a segment repeated in the batch is counted once, as it is translated once
+            for translation in dict(zip(keys, translations)).values():
+                if translation is None:
+                    self._misses += 1
+                else:
+                    self._hits += 1
+
+        return [translation.__class__(translation.text, score=translation.score)
+                if translation is not None and not alignment and translation.alignment is not None else translation
+                for translation in translations]
+
+    def put_all(self, items):
+        with self._lock:
+            for key, translation in items:
+                self._put(key, translation)
+
+        if self._store is not None:
+            self._store.put_all(items)
+
+    def _put(self, key, translation):
+        if self._cache is not None:
+            cached = self._cache.get(key)
+            if cached is None or cached.alignment is None:
+                self._cache[key] = translation
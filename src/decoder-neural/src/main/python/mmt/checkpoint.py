@@ -1,10 +1,19 @@
+import fcntl
+import json
 import logging
 import os
-from collections import defaultdict
+import shutil
+import tempfile
+import threading
+from collections import defaultdict, OrderedDict
 
+import cachetools
+import numpy as np
 import torch
 from fairseq import tasks
 from mmt import SubwordDictionary
+from mmt.quantization import CALIBRATION_FILE
+from mmt.shortlist import LEXICAL_TABLE_FILE
 from torch.serialization import default_restore_location
 
 
@@ -18,6 +27,76 @@ def resize_embeddings(tensor, size):
     return tensor
 
 
+def convert_checkpoint(checkpoint_path, output_path=None, embeddings_size=None):
+    """
+    Stores the weights of checkpoint_path/model.pt in a memory-mappable format: raw tensor data (model.bin)
+    and an index with name, dtype, shape and offset of each tensor (model.idx, together with args and decode stats).
+    If embeddings_size is specified, embeddings are stored already resized to it.
+    """
+    output_path = output_path or checkpoint_path
+
+    model_pt_path = os.path.join(checkpoint_path, 'model.pt')
+    model_pt = torch.load(model_pt_path, map_location=lambda s, l: default_restore_location(s, 'cpu'))
+
+    # concurrent conversions to the same path are serialized by a lock, every file is written to a unique temporary
+    # file and the index is published last: a reader that finds an up-to-date model.idx also finds its model.bin
+    with open(os.path.join(output_path, '.model.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        tmp_paths = []
+
+        try:
+            data_fd, data_tmp_path = tempfile.mkstemp(dir=output_path, prefix='.model.bin.')
+            tmp_paths.append(data_tmp_path)
+
+            index, offset = [], 0
+            with os.fdopen(data_fd, 'wb') as data:
+                for name, tensor in model_pt['model'].items():
+                    if name.endswith('embed_tokens.weight') and embeddings_size is not None \
+                            and tensor.shape[0] < embeddings_size:
+                        tensor = resize_embeddings(tensor, embeddings_size)
+
+                    buffer = tensor.detach().contiguous().view(-1).view(torch.uint8).numpy().tobytes()
+                    padding = -offset % 64  # keep every tensor aligned
+
+                    data.write(b'\0' * padding)
+                    data.write(buffer)
+
+                    index.append((name, tensor.dtype, tuple(tensor.shape), offset + padding, len(buffer)))
+                    offset += padding + len(buffer)
+
+            index_fd, index_tmp_path = tempfile.mkstemp(dir=output_path, prefix='.model.idx.')
+            tmp_paths.append(index_tmp_path)
+
+            with os.fdopen(index_fd, 'wb') as f:
+                torch.save({
+                    'args': model_pt['args'],
+                    'decode_stats': model_pt['decode_stats'] if 'decode_stats' in model_pt else None,
+                    'index': index
+                }, f)
+
+            for tmp_path in tmp_paths:
+                shutil.copymode(model_pt_path, tmp_path)  # mkstemp() files are only readable by their owner
+
+            os.replace(data_tmp_path, os.path.join(output_path, 'model.bin'))
+            os.replace(index_tmp_path, os.path.join(output_path, 'model.idx'))
+        except BaseException:
+            for tmp_path in tmp_paths:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            raise
+
+
+def _map_state(checkpoint_path, index):
+    data = np.memmap(os.path.join(checkpoint_path, 'model.bin'), dtype=np.uint8, mode='c')
+
+    state = OrderedDict()
+    for name, dtype, shape, offset, length in index:
+        state[name] = torch.from_numpy(data[offset:offset + length]).view(dtype).reshape(shape)
+
+    return state
+
+
 class UnsupportedLanguageException(KeyError):
     def __init__(self, source_language, target_language, *args: object) -> None:
         super().__init__("unsupported language: %s > %s" % (source_language, target_language), *args)
@@ -32,6 +111,10 @@ class Checkpoint(object):
         self._multilingual_target = multilingual_target
         self._logger = logging.getLogger(self.__class__.__name__)
 
+    @property
+    def path(self):
+        return self._checkpoint_path
+
     @property
     def multilingual_target(self):
         return self._multilingual_target
@@ -59,6 +142,8 @@ class Checkpoint(object):
         else:
             avg, std_dev = self._decode_stats[lang_key]
 
+        if torch.is_tensor(source_length):
+            return (source_length.double() * (avg + 4 * std_dev)).long() + 20
         return int(source_length * (avg + 4 * std_dev)) + 20
 
     def __eq__(self, o):
@@ -79,49 +164,190 @@ class Checkpoint(object):
         return str(self)
 
 
+class LazyCheckpoint(Checkpoint):
+    """
+    A checkpoint whose weights are memory-mapped from model.bin on first access to state (see convert_checkpoint)
+    and kept in a shared LRU cache, that drops the least recently used states above its memory limit
+    """
+
+    def __init__(self, task, index, decode_stats, states_cache, embeddings_size=None, multilingual_target=False):
+        super().__init__(task, None, decode_stats, multilingual_target=multilingual_target)
+        self._index = index
+        self._states_cache = states_cache
+        self._embeddings_size = embeddings_size
+
+    @property
+    def state(self):
+        return self._states_cache.get(self)
+
+    def size_in_bytes(self):
+        size = 0
+        for name, dtype, shape, _, length in self._index:
+            if name.endswith('embed_tokens.weight') and self._embeddings_size is not None:
+                length = max(length, length // shape[0] * self._embeddings_size)
+            size += length
+
+        return int(size * 1.6)  # overhead
+
+    def materialize(self):
+        state = _map_state(self._checkpoint_path, self._index)
+
+        # Resize embeddings
+        for name in ('encoder.embed_tokens.weight', 'decoder.embed_tokens.weight'):
+            if self._embeddings_size is not None and state[name].shape[0] < self._embeddings_size:
+                state[name] = resize_embeddings(state[name], self._embeddings_size)
+
+        return state
+
+
+class _StatesCache(object):
+    def __init__(self, max_size=None):
+        self._max_size = max_size if max_size is not None else float('inf')
+        self._cache = None
+        self._lock = threading.Lock()
+
+    def reserve(self, checkpoints):
+        # the largest checkpoint must always fit, regardless of the limit
+        max_size = max([self._max_size] + [checkpoint.size_in_bytes() for checkpoint in checkpoints])
+        self._cache = cachetools.LRUCache(maxsize=max_size, getsizeof=lambda e: e[1])
+
+    def get(self, checkpoint):
+        with self._lock:
+            entry = self._cache.get(checkpoint)
+            if entry is None:
+                entry = checkpoint.materialize(), checkpoint.size_in_bytes()
+                self._cache[checkpoint] = entry
+
+            return entry[0]
+
+
 class CheckpointRegistry(object):
+    BUNDLE_MANIFEST = 'model.manifest'
+
+    @classmethod
+    def is_bundle(cls, path):
+        return os.path.isfile(os.path.join(path, cls.BUNDLE_MANIFEST))
+
     class Builder(object):
         def __init__(self):
             self._checkpoints_names = set()
             self._checkpoints_by_path = defaultdict(list)
+            self._vocab_sizes = {}
             self._max_vocab_size = 0
 
         @property
         def embeddings_size(self):
             return self._max_vocab_size
 
-        def register(self, name, checkpoint_path):
+        def register(self, name, checkpoint_path, vocab_size=None):
             if name in self._checkpoints_names:
                 raise ValueError('Checkpoint with name "%s" already registered' % name)
 
             self._checkpoints_names.add(name)
             self._checkpoints_by_path[checkpoint_path].append(name)
 
-            dict_path = os.path.join(checkpoint_path, 'model.vcb')
-            self._max_vocab_size = max(self._max_vocab_size, SubwordDictionary.size_of(dict_path))
+            if vocab_size is None:
+                vocab_size = SubwordDictionary.size_of(os.path.join(checkpoint_path, 'model.vcb'))
+            self._vocab_sizes[checkpoint_path] = vocab_size
+            self._max_vocab_size = max(self._max_vocab_size, vocab_size)
+
+            return self
+
+        def register_bundle(self, bundle_path):
+            with open(os.path.join(bundle_path, CheckpointRegistry.BUNDLE_MANIFEST), 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+
+            for entry in manifest['checkpoints']:
+                for name in entry['names']:
+                    self.register(name, os.path.join(bundle_path, entry['path']), vocab_size=entry['vocab_size'])
 
             return self
 
-        def build(self, device=None):
+        def pack(self, output_path):
+            """
+            Writes a deployment bundle of the registered checkpoints in output_path: for each checkpoint, weights are
+            stored in the format of convert_checkpoint() with embeddings already resized to embeddings_size, next to
+            a pre-indexed copy of its dictionary (model.dct); a manifest lists checkpoints names and vocabulary sizes.
+            Register a bundle with register_bundle(): it is then loaded as it is, without conversions or resizing.
+            """
+            os.makedirs(output_path, exist_ok=True)
+
+            manifest = {'embeddings_size': self._max_vocab_size, 'checkpoints': []}
+            paths = set()
+
+            for checkpoint_path, names in self._checkpoints_by_path.items():
+                path = basename = os.path.basename(os.path.normpath(checkpoint_path))
+                suffix = 1
+                while path in paths:
+                    suffix += 1
+                    path = '%s_%d' % (basename, suffix)
+                paths.add(path)
+
+                bundle_checkpoint_path = os.path.join(output_path, path)
+                os.makedirs(bundle_checkpoint_path, exist_ok=True)
+
+                convert_checkpoint(checkpoint_path, bundle_checkpoint_path, embeddings_size=self._max_vocab_size)
+
+                dict_path = os.path.join(checkpoint_path, 'model.vcb')
+                shutil.copyfile(dict_path, os.path.join(bundle_checkpoint_path, 'model.vcb'))
+
+                dictionary = SubwordDictionary.load(dict_path)
+                dictionary.force_length(self._max_vocab_size)
+                dictionary.save_indexed(os.path.join(bundle_checkpoint_path, 'model.dct'))
+
+                for filename in (CALIBRATION_FILE, LEXICAL_TABLE_FILE):
+                    if os.path.isfile(os.path.join(checkpoint_path, filename)):
+                        shutil.copyfile(os.path.join(checkpoint_path, filename),
+                                        os.path.join(bundle_checkpoint_path, filename))
+
+                manifest['checkpoints'].append({
+                    'path': path, 'names': names, 'vocab_size': self._vocab_sizes[checkpoint_path]
+                })
+
+            with open(os.path.join(output_path, CheckpointRegistry.BUNDLE_MANIFEST), 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, indent=2)
+
+        def build(self, device=None, lazy=False, max_memory_mb=None):
+            # With lazy=True only the index of every checkpoint is loaded at startup (the checkpoint is converted
+            # with convert_checkpoint() if needed): weights are memory-mapped on first use and the states of
+            # the least recently used checkpoints are dropped above max_memory_mb
             checkpoints = {}
+            states_cache = _StatesCache(max_memory_mb * 1024 * 1024 if max_memory_mb is not None else None)
 
             for path, keys in self._checkpoints_by_path.items():
-                args, model_state, decode_stats = self._load(path, self._max_vocab_size)
+                if lazy:
+                    args, index, decode_stats = self._load_index(path)
+                else:
+                    args, model_state, decode_stats = self._load(path, self._max_vocab_size)
+
                 task = tasks.setup_task(args)
-                task.source_dictionary.force_length(self._max_vocab_size)
+                if len(task.source_dictionary) < self._max_vocab_size:
+                    task.source_dictionary.force_length(self._max_vocab_size)
 
                 target_languages = set([key.split('__', 1)[1] for key in keys])
 
-                checkpoint = self._mk_checkpoint(task, model_state, decode_stats,
-                                                 multilingual_target=len(target_languages) > 1)
+                if lazy:
+                    checkpoint = LazyCheckpoint(task, index, decode_stats, states_cache,
+                                                embeddings_size=self._max_vocab_size,
+                                                multilingual_target=len(target_languages) > 1)
+                else:
+                    checkpoint = self._mk_checkpoint(task, model_state, decode_stats,
+                                                     multilingual_target=len(target_languages) > 1)
 
                 for key in keys:
                     checkpoints[key] = checkpoint
 
+            if lazy:
+                states_cache.reserve(set(checkpoints.values()))
             return self._mk_registry(checkpoints, device)
 
         def _load(self, checkpoint_path, embeddings_size=None):
             model_pt_path = os.path.join(checkpoint_path, 'model.pt')
+            if not os.path.isfile(model_pt_path) and os.path.isfile(os.path.join(checkpoint_path, 'model.idx')):
+                # deployment bundle (see pack()): weights are memory-mapped as they are
+                args, index, decode_stats = self._load_index(checkpoint_path)
+                return args, _map_state(checkpoint_path, index), decode_stats
+
             if not os.path.isfile(model_pt_path):
                 raise IOError('Model file not found: {}'.format(model_pt_path))
 
@@ -140,6 +366,22 @@ class CheckpointRegistry(object):
             args.data = checkpoint_path
             return args, model_state, decode_stats
 
+        def _load_index(self, checkpoint_path):
+            model_pt_path = os.path.join(checkpoint_path, 'model.pt')
+            model_idx_path = os.path.join(checkpoint_path, 'model.idx')
+
+            if not os.path.isfile(model_idx_path) or \
+                    (os.path.isfile(model_pt_path) and os.path.getmtime(model_pt_path) > os.path.getmtime(model_idx_path)):
+                if not os.path.isfile(model_pt_path):
+                    raise IOError('Model file not found: {}'.format(model_pt_path))
+                convert_checkpoint(checkpoint_path)
+
+            model_idx = torch.load(model_idx_path)
+            args, index, decode_stats = model_idx['args'], model_idx['index'], model_idx['decode_stats']
+
+            args.data = checkpoint_path
+            return args, index, decode_stats
+
         def _mk_checkpoint(self, task, model_state, decode_stats, multilingual_target):
             return Checkpoint(task, model_state, decode_stats, multilingual_target=multilingual_target)
 
@@ -163,6 +405,18 @@ class CheckpointRegistry(object):
         else:
             raise UnsupportedLanguageException(source_lang, target_lang)
 
+    def sample(self):
+        # any of the checkpoints: they all have the same architecture
+        return next(iter(self._checkpoints.values()))
+
+    def max_size_in_bytes(self):
+        return max(checkpoint.size_in_bytes() for checkpoint in self._checkpoints.values())
+
+    def preload(self):
+        # loads the weights of all the checkpoints now (lazy checkpoints within the memory limit of their cache)
+        for checkpoint in dict.fromkeys(self._checkpoints.values()):
+            _ = checkpoint.state
+
     def __len__(self):
         return len(self._checkpoints)
 
@@ -4,14 +4,18 @@ import math
 import os
 import time
 
+import cachetools
 import fairseq
-import numpy as np
 import torch
 from fairseq.models.transformer import TransformerModel
 from fairseq.sequence_generator import SequenceGenerator
 
 from mmt import textencoder, is_fairseq_0_12
-from mmt.alignment import make_alignment, clean_alignment
+from mmt.alignment import make_alignments, clean_alignment
+from mmt.arena import DecoderStateArena
+from mmt.cache import TranslationCache, TranslationStore
+from mmt.quantization import LinearQuantizer, load_calibration, save_calibration
+from mmt.shortlist import load_lexical_table, make_shortlist
 from mmt.tuning import Tuner, TuningOptions
 
 
@@ -31,6 +35,81 @@ class Suggestion(object):
         self.score = score
 
 
+def _similarity(words, other_words):
+    # 1 - word-level edit distance / length of the longest sequence (1.0 is an exact match)
+    length = max(len(words), len(other_words))
+    if length == 0:
+        return 1.
+
+    distances = list(range(len(other_words) + 1))
+    for i, word in enumerate(words):
+        previous, distances[0] = distances[0], i + 1
+        for j, other_word in enumerate(other_words):
+            previous, distances[j + 1] = distances[j + 1], min(distances[j + 1] + 1, distances[j] + 1,
+                                                               previous + (word != other_word))
+
+    return 1. - distances[-1] / length
+
+
+def _share_tensor(tensor, value):
+    # a parameter matching value in dtype, device and shape becomes a view of it, anything else is copied
+    if isinstance(tensor, torch.nn.Parameter) and tensor.dtype == value.dtype and tensor.device == value.device \
+            and tensor.shape == value.shape:
+        tensor.data = value
+    else:
+        tensor.copy_(value)
+
+
+def _load_shared_state(model, state):
+    """
+    Same as model.load_state_dict(state, strict=True), but the parameters of model are views of the tensors
+    of state instead of copies: models forked from the process that loaded state share its memory.
+    """
+    tensors = model.state_dict(keep_vars=True)
+
+    missing, unexpected = sorted(set(tensors) - set(state)), sorted(set(state) - set(tensors))
+    if len(missing) > 0 or len(unexpected) > 0:
+        raise RuntimeError('Error(s) in loading state_dict: missing keys %s, unexpected keys %s'
+                           % (missing, unexpected))
+
+    with torch.no_grad():
+        for name, tensor in tensors.items():
+            _share_tensor(tensor, state[name])
+
+
+class _ModelInstance(object):
+    def __init__(self, model, translator, tuner, arena=None, quantizer=None):
+        self.model = model
+        self.translator = translator
+        self.tuner = tuner
+        self.arena = arena
+        self.quantizer = quantizer
+        self.translators = {}  # generators with a beam size other than the default one
+        self.checkpoint = None
+        self.needs_reset = True
+
+
+class DecoderOptions(object):
+    def __init__(self):
+        self.decoder_state_arena = False
+        self.decoder_max_batch_tokens = None
+        self.decoder_model_pool_mb = None
+        self.decoder_sentence_max_length = True
+        self.decoder_lazy_checkpoints = False
+        self.decoder_checkpoints_memory_mb = None
+        self.decoder_int8 = False
+        self.decoder_shortlist = False
+        self.decoder_shortlist_frequent = 2000
+        self.decoder_greedy_fallback_score = None
+        self.decoder_cache_size = None
+        self.decoder_cache_path = None
+        self.decoder_cache_max_entries = None
+        self.decoder_suggestion_match_score = None
+
+    def __str__(self):
+        return str(self.__dict__)
+
+
 class ModelConfig(object):
     __custom_values = {'True': True, 'False': False, 'None': None}
 
@@ -56,18 +135,24 @@ class ModelConfig(object):
 
         return value
 
-    @property
-    def tuning(self):
-        ops = TuningOptions()
-
+    def _options(self, ops, *others):
         if self._config.has_section('settings'):
             for name, value in self._config.items('settings'):
-                if not hasattr(ops, name):
+                if hasattr(ops, name):
+                    setattr(ops, name, self._parse(value))
+                elif not any(hasattr(other, name) for other in others):
                     raise ValueError('Invalid option "%s"' % name)
-                setattr(ops, name, self._parse(value))
 
         return ops
 
+    @property
+    def tuning(self):
+        return self._options(TuningOptions(), DecoderOptions())
+
+    @property
+    def decoder(self):
+        return self._options(DecoderOptions(), TuningOptions())
+
     @property
     def checkpoints(self):
         def normalize_lang(lang):
@@ -90,6 +175,15 @@ class ModelConfig(object):
 
         return result
 
+    def save(self, model_path, checkpoints=True):
+        config = configparser.ConfigParser()
+        config.read_dict(self._config)
+        if not checkpoints:
+            config.remove_section('models')
+
+        with open(os.path.join(model_path, 'model.conf'), 'w', encoding='utf-8') as f:
+            config.write(f)
+
 
 class MMTDecoder(object):
     @classmethod
@@ -131,8 +225,9 @@ class MMTDecoder(object):
         return SequenceGenerator(*args, **kwargs)
 
     @classmethod
-    def _create_tuner(cls, checkpoints, model, tuning_ops, device):
-        return Tuner(checkpoints.args, checkpoints.task, model, tuning_ops=tuning_ops, device=device)
+    def _create_tuner(cls, checkpoints, model, tuning_ops, device, copy_on_write=False):
+        return Tuner(checkpoints.args, checkpoints.task, model, tuning_ops=tuning_ops, device=device,
+                     copy_on_write=copy_on_write)
 
     @classmethod
     def port_to_fairseq_0_12(cls, checkpoint):
@@ -142,31 +237,92 @@ class MMTDecoder(object):
             if missing not in checkpoint.args:
                 setattr(checkpoint.args, missing, missing_default_params[missing])
 
-    def __init__(self, checkpoints, device=None, beam_size=5, use_fp16=False, tuning_ops=None):
+    def __init__(self, checkpoints, device=None, beam_size=5, use_fp16=False, tuning_ops=None, decoder_ops=None,
+                 share_weights=False):
         torch.manual_seed(checkpoints.args.seed)
 
         self._checkpoints = checkpoints
         self._checkpoints.args.fp16 = use_fp16
+        self._decoder_ops = decoder_ops if decoder_ops is not None else DecoderOptions()
 
         if is_fairseq_0_12():
             self.port_to_fairseq_0_12(self._checkpoints)
 
         self._device = device
-        self._model = self._fix_model_probs(
-            self._create_model(checkpoints, device=device, beam_size=beam_size, use_fp16=use_fp16)
-        )
-        self._translator = self._create_translator([self._model], checkpoints, beam_size)
-        self._tuner = self._create_tuner(checkpoints, self._model, tuning_ops, device)
+        self._beam_size = beam_size
+        self._use_fp16 = use_fp16
+        self._share_weights = share_weights  # parameters are views of the checkpoint weights (see DecoderWorkers)
+        self._tuning_ops = tuning_ops if tuning_ops is not None else TuningOptions()
+        self._logger = logging.getLogger('Transformer')
+
+        if self._decoder_ops.decoder_int8 and device is not None:
+            self._logger.warning('int8 quantization is only supported on CPU, ignoring decoder_int8 on GPU')
+            self._decoder_ops.decoder_int8 = False
+
+        self._instance = self._create_instance()
+        self._model, self._translator, self._tuner, self._arena, self._quantizer = \
+            self._instance.model, self._instance.translator, self._instance.tuner, self._instance.arena, \
+            self._instance.quantizer
+
+        self._model_pool = None
+        if self._decoder_ops.decoder_model_pool_mb is not None:
+            max_size = max(int(self._decoder_ops.decoder_model_pool_mb * 1024 * 1024),
+                           checkpoints.max_size_in_bytes())
+            self._model_pool = cachetools.LRUCache(maxsize=max_size, getsizeof=lambda e: e.checkpoint.size_in_bytes())
+
         self._max_positions = fairseq.utils.resolve_max_positions(
             checkpoints.task.max_positions(),
             self._model.max_positions(),
         )
 
-        self._logger = logging.getLogger('Transformer')
-
+        self._cache = None
+        if self._decoder_ops.decoder_cache_size is not None or self._decoder_ops.decoder_cache_path is not None:
+            store = None
+            if self._decoder_ops.decoder_cache_path is not None:
+                # any change to the settings affecting translations makes stored entries unusable
+                signature = sorted((name, str(value)) for name, value in self._decoder_ops.__dict__.items()
+                                   if not name.startswith('decoder_cache_'))
+                store = TranslationStore(self._decoder_ops.decoder_cache_path, Translation,
+                                         max_entries=self._decoder_ops.decoder_cache_max_entries,
+                                         signature=[beam_size, use_fp16, signature])
+
+            self._cache = TranslationCache(self._decoder_ops.decoder_cache_size, store=store)
+
+        self._calibrations = {}
+        self._lexical_tables = {}
+        self._shortlist = None
+        self._decode_word_cost = None  # seconds per source word, measured on the previous translations
         self._nn_needs_reset = True
+        self._need_attn = True
+        self._max_lengths = None
         self._checkpoint = None
 
+    def _create_instance(self):
+        model = self._fix_model_shortlist(self._fix_model_length(self._fix_model_attn(self._fix_model_probs(
+            self._create_model(self._checkpoints, device=self._device, beam_size=self._beam_size,
+                               use_fp16=self._use_fp16)
+        ))))
+
+        if self._share_weights:
+            # the weights built by the model are released now, not at its first reset
+            _load_shared_state(model, self._checkpoints.sample().state)
+
+        arena = None
+        if self._decoder_ops.decoder_state_arena:
+            arena = DecoderStateArena()
+            arena.install(model)
+
+        quantizer = None
+        if self._decoder_ops.decoder_int8:
+            quantizer = LinearQuantizer()
+            quantizer.install(model)
+
+        translator = self._create_translator([model], self._checkpoints, self._beam_size)
+        tuner = self._create_tuner(self._checkpoints, model, self._tuning_ops, self._device,
+                                   copy_on_write=self._share_weights)
+
+        return _ModelInstance(model, translator, tuner, arena=arena, quantizer=quantizer)
+
     def _fix_model_probs(self, model):
         # Handling of multilingual engines with varying vocab sizes with resistance
         # to negative logits, for which we need to override `model.get_normalized_probs`
@@ -212,56 +368,453 @@ class MMTDecoder(object):
         model.get_normalized_probs = _get_normalized_log_probs
         return model
 
+    def _fix_model_attn(self, model):
+        # Cross-attention weights are only used to compute word alignment: when it is not requested,
+        # no decoder layer is asked for them (alignment_layer=-1 matches none of them)
+        # and the generator does not collect attention at all
+        _decoder_forward = model.decoder.forward
+
+        def _forward(*args, **kwargs):
+            if not self._need_attn:
+                kwargs['alignment_layer'] = -1
+            return _decoder_forward(*args, **kwargs)
+
+        model.decoder.forward = _forward
+        return model
+
+    def _fix_model_length(self, model):
+        # The generator stops all the sentences of the batch at the decode length of the longest one:
+        # here every beam is limited to the decode length of its own sentence, after which only EOS can be
+        # selected (as fairseq does at the batch limit). Source lengths in encoder_out follow the reorders
+        # of the generator, both of beams and of finished sentences removed from the batch.
+        _decoder_forward = model.decoder.forward
+        _get_normalized_probs = model.get_normalized_probs
+
+        def _forward(prev_output_tokens, *args, **kwargs):
+            net_output = _decoder_forward(prev_output_tokens, *args, **kwargs)
+
+            encoder_out = kwargs['encoder_out'] if 'encoder_out' in kwargs else (args[0] if len(args) > 0 else None)
+            if self._max_lengths is not None and isinstance(encoder_out, dict) and \
+                    len(encoder_out.get('src_lengths', [])) > 0:
+                step = prev_output_tokens.size(1) - 1
+                src_lengths = encoder_out['src_lengths'][0].view(-1).long()
+                net_output[1]['limit_reached'] = step >= self._max_lengths[src_lengths]
+
+            return net_output
+
+        def _get_normalized_probs_with_limit(net_output, *args, **kwargs):
+            probs = _get_normalized_probs(net_output, *args, **kwargs)
+
+            extra = net_output[1] if len(net_output) > 1 else None
+            if isinstance(extra, dict) and 'limit_reached' in extra:
+                not_eos = torch.ones(probs.size(-1), dtype=torch.bool, device=probs.device)
+                not_eos[self._checkpoint.subword_dictionary.eos()] = False
+                probs[:, -1].masked_fill_(extra['limit_reached'][:, None] & not_eos[None], -math.inf)
+
+            return probs
+
+        model.decoder.forward = _forward
+        model.get_normalized_probs = _get_normalized_probs_with_limit
+        return model
+
+    def _fix_model_shortlist(self, model):
+        # With a shortlist (the candidate subwords of the batch being decoded, see decoder_shortlist) the output
+        # projection is computed for its rows only: the logits of all the other subwords are -inf
+        _output_layer = model.decoder.output_layer
+
+        def _output_layer_with_shortlist(features, *args, **kwargs):
+            if self._shortlist is None:
+                return _output_layer(features, *args, **kwargs)
+
+            ids, weight, bias = self._shortlist
+            logits = features.new_full(features.shape[:-1] + (model.decoder.output_projection.out_features,),
+                                       -math.inf)
+            logits.index_copy_(-1, ids, torch.nn.functional.linear(features, weight, bias))
+
+            return logits
+
+        model.decoder.output_layer = _output_layer_with_shortlist
+        return model
+
+    def _set_shortlist(self, tokens):
+        checkpoint = self._checkpoint
+        if checkpoint not in self._lexical_tables:
+            self._lexical_tables[checkpoint] = load_lexical_table(checkpoint.path, checkpoint.subword_dictionary)
+
+        ids = make_shortlist(checkpoint.subword_dictionary, tokens, lexical_table=self._lexical_tables[checkpoint],
+                             frequent=self._decoder_ops.decoder_shortlist_frequent)
+        if self._device is not None:
+            ids = ids.cuda(self._device)
+
+        output_projection = self._model.decoder.output_projection
+        with torch.no_grad():
+            weight = output_projection.weight.index_select(0, ids)
+            bias = output_projection.bias.index_select(0, ids) if output_projection.bias is not None else None
+
+        self._shortlist = ids, weight, bias
+
+    def _set_need_attn(self, need_attn):
+        self._need_attn = need_attn
+        for layer in self._model.decoder.layers:
+            layer.need_attn = need_attn
+
     # - High level functions -------------------------------------------------------------------------------------------
 
+    @property
+    def device(self):
+        return self._device
+
+    def encode(self, source_lang, target_lang, batch):
+        # Subword encoding of a batch: it does not use the model, so it can be computed in advance
+        # (even by another thread) and passed to translate()
+        checkpoint = self._checkpoints.load(source_lang, target_lang)
+        prefix_lang = target_lang if checkpoint.multilingual_target else None
+        return self._encode(batch, prefix_lang=prefix_lang, checkpoint=checkpoint)
+
     def test(self):
         test_batch, _, _ = self._make_decode_batch([])
 
         begin = time.time()
-        self._translator.max_len_b = 1
-        self._translator.generate([self._model], test_batch)
+        translator = self._get_translator(self._beam_size)
+        translator.max_len_b = 1
+        translator.generate([self._model], test_batch)
         test_time = time.time() - begin
 
         self._logger.info('test_time = %.3f' % test_time)
 
-    def translate(self, source_lang, target_lang, batch, suggestions=None,
-                  tuning_epochs=None, tuning_learning_rate=None, forced_translation=None):
+    def translate(self, source_lang, target_lang, batch, suggestions=None, tuning_epochs=None,
+                  tuning_learning_rate=None, forced_translation=None, alignment=True, tokens=None, beam_size=None,
+                  latency_budget=None):
+        # beam_size overrides the beam size of the decoder for this request (1 is greedy decoding); if not specified
+        # and decoder_greedy_fallback_score is set, segments are decoded greedily first and decoded again with
+        # the full beam only if the score of the greedy translation is lower than decoder_greedy_fallback_score.
+        # With latency_budget (seconds), tuning is reduced or skipped to fit in the time left for the request
+        if beam_size is not None and beam_size < 1:
+            raise ValueError('Invalid beam size: %d' % beam_size)
+
+        if self._cache is not None and (suggestions is None or len(suggestions) == 0) and forced_translation is None:
+            return self._translate_cached(source_lang, target_lang, batch, alignment=alignment, tokens=tokens,
+                                          beam_size=beam_size)
+
+        return self._translate(source_lang, target_lang, batch, suggestions=suggestions, tuning_epochs=tuning_epochs,
+                               tuning_learning_rate=tuning_learning_rate, forced_translation=forced_translation,
+                               alignment=alignment, tokens=tokens, beam_size=beam_size, latency_budget=latency_budget)
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def _translate_cached(self, source_lang, target_lang, batch, alignment=True, tokens=None, beam_size=None):
+        # Only the segments not found in cache are translated (once, if repeated in the batch) and the batch is
+        # reassembled in the original order: if all of them are found, the model is not even reset to the
+        # checkpoint of the language pair
+        checkpoint = self._checkpoints.load(source_lang, target_lang)
+
+        keys = [TranslationCache.key(checkpoint, source_lang, target_lang, segment, beam_size) for segment in batch]
+        results = self._cache.get_all(keys, alignment=alignment)
+
+        missing = {}
+        for i, (key, result) in enumerate(zip(keys, results)):
+            if result is None and key not in missing:
+                missing[key] = i
+
+        if len(missing) > 0:
+            indexes = list(missing.values())
+            translations = self._translate(source_lang, target_lang, [batch[i] for i in indexes],
+                                           alignment=alignment, beam_size=beam_size,
+                                           tokens=[tokens[i] for i in indexes] if tokens is not None else None)
+
+            translated = {keys[i]: translation for i, translation in zip(indexes, translations)}
+            self._cache.put_all(list(translated.items()))
+
+            results = [result if result is not None else translated[key] for key, result in zip(keys, results)]
+
+        self._logger.info('cache_misses = %d/%d, cache_hit_rate = %.3f'
+                          % (len(missing), len(batch), self._cache.hit_rate))
+
+        return results
+
+    def _translate(self, source_lang, target_lang, batch, suggestions=None, tuning_epochs=None,
+                   tuning_learning_rate=None, forced_translation=None, alignment=True, tokens=None, beam_size=None,
+                   latency_budget=None, isolated=False):
+        # With isolated=True tuning does not modify the model: the request is decoded with its own parameter delta
         # (1) Reset model (if necessary)
         begin = time.time()
         self._reset_model(source_lang, target_lang)
         reset_time = time.time() - begin
 
-        # (2) Tune engine if suggestions provided
+        # (2) Segments matching a suggestion take its translation (force decoded for word alignment):
+        # only the other ones are tuned and decoded
+        begin = time.time()
+        matches, matched = {}, None
+        if forced_translation is None and suggestions is not None and len(suggestions) > 0 and \
+                self._decoder_ops.decoder_suggestion_match_score is not None:
+            matches = self._match_suggestions(source_lang, target_lang, batch, suggestions)
+
+        if len(matches) > 0:
+            indexes = sorted(matches)
+            matched = self._force_decode(target_lang, [batch[i] for i in indexes], [matches[i] for i in indexes],
+                                         alignment=alignment)
+
+            batch_size = len(batch)
+            batch = [segment for i, segment in enumerate(batch) if i not in matches]
+            if tokens is not None:
+                tokens = [t for i, t in enumerate(tokens) if i not in matches]
+
+            self._logger.info('suggestion_matches = %d/%d' % (len(matches), batch_size))
+        match_time = time.time() - begin
+
+        # (3) Tune engine if suggestions provided
         begin = time.time()
-        if suggestions is not None and len(suggestions) > 0:
-            self._tune(suggestions, epochs=tuning_epochs, learning_rate=tuning_learning_rate)
+        delta = None
+        if suggestions is not None and len(suggestions) > 0 and len(batch) > 0:
+            budget = None
+            if latency_budget is not None:
+                # the time left for tuning: what remains after the reset, minus the expected decoding time
+                words = sum(len(segment.split()) for segment in batch)
+                budget = latency_budget - reset_time - match_time - words * (self._decode_word_cost or 0.)
+
+            delta = self._tune(suggestions, epochs=tuning_epochs, learning_rate=tuning_learning_rate, segments=batch,
+                               budget=budget, isolated=isolated)
         tune_time = time.time() - begin
 
-        # (3) Translate and compute word alignment
+        # (4) Translate and compute word alignment
         begin = time.time()
-        if forced_translation is not None:
-            result = self._force_decode(target_lang, batch, forced_translation)
+        if len(batch) == 0:
+            result = []
+        elif forced_translation is not None:
+            result = self._with_delta(delta, self._force_decode, target_lang, batch, forced_translation,
+                                      alignment=alignment)
         else:
-            result = self._decode(source_lang, target_lang, batch)
+            result = self._with_delta(delta, self._decode, source_lang, target_lang, batch, alignment=alignment,
+                                      tokens=tokens, beam_size=beam_size)
 
         decode_time = time.time() - begin
 
+        if forced_translation is None:
+            words = sum(len(segment.split()) for segment in batch)
+            if words > 0:
+                word_cost = decode_time / words
+                self._decode_word_cost = word_cost if self._decode_word_cost is None \
+                    else .9 * self._decode_word_cost + .1 * word_cost
+
         self._logger.info('reset_time = %.3f, tune_time = %.3f, decode_time = %.3f'
                           % (reset_time, tune_time, decode_time))
 
+        if matched is not None:
+            matched, result = iter(matched), iter(result)
+            result = [next(matched) if i in matches else next(result) for i in range(len(matches) + len(batch))]
+
+        # (5) Shared weights: the tuned copies and the optimizer state are not kept until the next request
+        if self._share_weights:
+            self._tuner.release()
+            self._restore_tuned_parameters()
+
         return result
 
+    def _match_suggestions(self, source_lang, target_lang, segments, suggestions):
+        # Returns index -> translation of the best suggestion for every segment whose similarity with the segment
+        # of the suggestion (on the tokenized words, see _similarity) is at least decoder_suggestion_match_score
+        min_score = self._decoder_ops.decoder_suggestion_match_score
+
+        candidates = [(suggestion.segment.split(), suggestion.translation) for suggestion in suggestions
+                      if suggestion.source_lang == source_lang and suggestion.target_lang == target_lang]
+        exact = {}
+        for words, translation in candidates:
+            exact.setdefault(' '.join(words), translation)
+
+        matches = {}
+        for i, segment in enumerate(segments):
+            words = segment.split()
+
+            if ' '.join(words) in exact:
+                matches[i] = exact[' '.join(words)]
+            elif min_score < 1.:
+                best_score, best_translation = min_score, None
+                for other_words, translation in candidates:
+                    # the length difference alone is a bound of the similarity
+                    if 1. - abs(len(words) - len(other_words)) / max(len(words), len(other_words)) < best_score:
+                        continue
+
+                    score = _similarity(words, other_words)
+                    if score > best_score or (score == best_score and best_translation is None):
+                        best_score, best_translation = score, translation
+
+                if best_translation is not None:
+                    matches[i] = best_translation
+
+        return matches
+
+    def translate_all(self, requests):
+        # A window of queued requests, grouped by language pair so that the base model of each checkpoint is loaded
+        # once: the requests without suggestions are decoded together (one batch for each alignment and beam size),
+        # every adapted request is tuned on a parameter delta of its own (see ParameterDelta) and decoded with it.
+        # The base weights are never modified, hence nothing is restored between the requests of the window.
+        results = [None] * len(requests)
+
+        groups = {}
+        for i, request in enumerate(requests):
+            if request.batch is None:
+                results[i] = []
+                continue
+            groups.setdefault((request.source_lang, request.target_lang), []).append(i)
+
+        for (source_lang, target_lang), indexes in groups.items():
+            options = sorted(set((requests[i].alignment, requests[i].beam_size or 0) for i in indexes), reverse=True)
+
+            for alignment, beam_size in options:
+                plain = [i for i in indexes if len(requests[i].suggestions) == 0 and
+                         requests[i].forced_translation is None and requests[i].alignment == alignment and
+                         (requests[i].beam_size or 0) == beam_size]
+
+                if len(plain) > 0:
+                    segments = [segment for i in plain for segment in requests[i].batch]
+                    tokens = None
+                    if all(requests[i].tokens is not None for i in plain):
+                        tokens = [t for i in plain for t in requests[i].tokens]
+
+                    translations = self.translate(source_lang, target_lang, segments, alignment=alignment,
+                                                  tokens=tokens, beam_size=beam_size or None)
+
+                    offset = 0
+                    for i in plain:
+                        results[i] = translations[offset:offset + len(requests[i].batch)]
+                        offset += len(requests[i].batch)
+
+            for i in indexes:
+                if results[i] is None:
+                    request = requests[i]
+                    results[i] = self._translate(source_lang, target_lang, request.batch,
+                                                 suggestions=request.suggestions,
+                                                 forced_translation=request.forced_translation,
+                                                 alignment=request.alignment, tokens=request.tokens,
+                                                 beam_size=request.beam_size, latency_budget=request.latency_budget,
+                                                 isolated=True)
+
+        return results
+
+    def calibrate_int8(self, source_lang, target_lang, segments, max_error=0.05, batch_size=32):
+        # Decodes segments in float measuring the int8 error of every Linear layer: the layers above max_error are
+        # excluded from quantization, for the checkpoint of the language pair (the result is saved next to it)
+        if self._quantizer is None:
+            raise ValueError('int8 quantization is not enabled')
+
+        self._reset_model(source_lang, target_lang)
+
+        def run():
+            for i in range(0, len(segments), batch_size):
+                self._decode(source_lang, target_lang, segments[i:i + batch_size], alignment=False)
+
+        excluded, errors = self._quantizer.calibrate(run, max_error)
+        save_calibration(self._checkpoint.path, excluded, errors, max_error)
+
+        self._calibrations[self._checkpoint] = excluded
+        self._quantizer.quantize(excluded=excluded)
+
+        return excluded, errors
+
+    def check_int8(self, source_lang, target_lang, segments, batch_size=32):
+        # Translates segments both in float and int8, and compares translations and decoding times
+        if self._quantizer is None:
+            raise ValueError('int8 quantization is not enabled')
+
+        results, times = {}, {}
+        try:
+            for enabled in (False, True):
+                self._quantizer.enabled = enabled
+
+                begin = time.time()
+                results[enabled] = [translation for i in range(0, len(segments), batch_size) for translation in
+                                    self._translate(source_lang, target_lang, segments[i:i + batch_size],
+                                                    alignment=False)]
+                times[enabled] = time.time() - begin
+        finally:
+            self._quantizer.enabled = True
+
+        pairs = list(zip(results[False], results[True]))
+        return {
+            'segments': len(segments),
+            'identical': sum(1 for f, q in pairs if f.text == q.text) / max(1, len(pairs)),
+            'score_delta': sum(abs(f.score - q.score) for f, q in pairs) / max(1, len(pairs)),
+            'float_time': times[False],
+            'int8_time': times[True],
+            'speedup': times[False] / times[True] if times[True] > 0 else None
+        }
+
     # - Low level functions --------------------------------------------------------------------------------------------
 
     def _reset_model(self, source_lang, target_lang):
         checkpoint = self._checkpoints.load(source_lang, target_lang)
 
+        if self._model_pool is not None and checkpoint != self._checkpoint:
+            self._swap_model(checkpoint)
+
         if self._nn_needs_reset or checkpoint != self._checkpoint:
-            self._model.load_state_dict(checkpoint.state, strict=True)
+            if checkpoint != self._checkpoint:
+                self._tuner.release()  # the optimizer state is not reused across checkpoints
+            if self._share_weights:
+                _load_shared_state(self._model, checkpoint.state)
+            else:
+                self._model.load_state_dict(checkpoint.state, strict=True)
+            if self._quantizer is not None:
+                self._quantizer.quantize(excluded=self._calibration(checkpoint))
             self._checkpoint = checkpoint
             self._nn_needs_reset = False
+            self._tuner.clear_updated_parameters()
+        else:
+            self._restore_tuned_parameters()
+
+    def _calibration(self, checkpoint):
+        if checkpoint not in self._calibrations:
+            self._calibrations[checkpoint] = load_calibration(checkpoint.path)
+        return self._calibrations[checkpoint]
+
+    def _restore_tuned_parameters(self):
+        if len(self._tuner.updated_parameters) > 0:
+            self._restore_parameters(self._checkpoint, self._tuner.updated_parameters)
+            if self._quantizer is not None:
+                self._quantizer.update(self._tuner.updated_parameters)
+            self._tuner.clear_updated_parameters()
+
+    def _restore_parameters(self, checkpoint, names):
+        # restore only the tensors modified by the last tuning instead of the whole state dict
+        parameters = dict(self._model.named_parameters())
+        state = checkpoint.state
+
+        with torch.no_grad():
+            for name in names:
+                if self._share_weights:
+                    _share_tensor(parameters[name], state[name])  # drops the copy made by the tuner
+                else:
+                    parameters[name].copy_(state[name])
+
+    def _swap_model(self, checkpoint):
+        self._instance.needs_reset = self._nn_needs_reset
+        self._tuner.release()  # only the active instance keeps its optimizer, not counted in the pool size
+
+        instance = self._model_pool.get(checkpoint)
+
+        if instance is None:
+            if self._instance.checkpoint is None:
+                instance = self._instance  # first use of the model built at startup
+            elif self._model_pool.currsize + checkpoint.size_in_bytes() > self._model_pool.maxsize:
+                _, instance = self._model_pool.popitem()  # recycle the least recently used model
+            else:
+                instance = self._create_instance()
+
+            instance.checkpoint = checkpoint
+            instance.needs_reset = True
+            self._model_pool[checkpoint] = instance
+
+        self._instance = instance
+        self._model, self._translator, self._tuner, self._arena, self._quantizer = \
+            instance.model, instance.translator, instance.tuner, instance.arena, instance.quantizer
+        self._nn_needs_reset = instance.needs_reset
+        self._checkpoint = checkpoint
+
+    def _tune(self, suggestions, epochs=None, learning_rate=None, segments=None, budget=None, isolated=False):
+        # With isolated=True the model is not modified: the ParameterDelta learned is returned (None if not tuned)
 
-    def _tune(self, suggestions, epochs=None, learning_rate=None):
         # Set tuning parameters
         if epochs is None or learning_rate is None:
             _epochs, _learning_rate = self._tuner.estimate_tuning_parameters(suggestions)
@@ -280,42 +833,168 @@ class MMTDecoder(object):
             tgt_samples = [e.translation for e in suggestions]
 
             dataset = self._tuner.dataset(src_samples, tgt_samples, sub_dict)
-            self._tuner.tune(dataset, num_iterations=epochs, lr=learning_rate)
-            self._nn_needs_reset = True
 
-    def _decode(self, source_lang, target_lang, segments):
+            if budget is not None:
+                size = len(dataset)
+                dataset, epochs = self._tuner.schedule(dataset, segments, suggestions, epochs, budget)
+                self._logger.info('tuning_budget = %.3f, tuning_epochs = %d, tuning_suggestions = %d/%d'
+                                  % (budget, epochs, len(dataset) if epochs > 0 else 0, size))
+
+            if epochs > 0 and isolated:
+                delta = self._tuner.delta()
+                self._tuner.tune(dataset, num_iterations=epochs, lr=learning_rate, delta=delta)
+                self._model.eval()
+
+                return delta
+            elif epochs > 0:
+                self._tuner.tune(dataset, num_iterations=epochs, lr=learning_rate)
+                self._model.eval()
+
+                if self._quantizer is not None:
+                    self._quantizer.update(self._tuner.updated_parameters)
+
+                if not self._tuning_ops.tuning_delta_restore:
+                    self._nn_needs_reset = True
+
+        return None
+
+    def _with_delta(self, delta, fn, *args, **kwargs):
+        # calls fn with the parameters of a request: int8 layers are packed from the base weights, they are bypassed
+        if delta is None:
+            return fn(*args, **kwargs)
+
+        if self._quantizer is not None:
+            self._quantizer.enabled = False
+
+        try:
+            with torch.no_grad():
+                return delta.apply(fn, *args, **kwargs)
+        finally:
+            if self._quantizer is not None:
+                self._quantizer.enabled = True
+
+    def _decode(self, source_lang, target_lang, segments, alignment=True, tokens=None, beam_size=None):
         prefix_lang = target_lang if self._checkpoint.multilingual_target else None
-        batch, input_indexes, sentence_len = self._make_decode_batch(segments, prefix_lang=prefix_lang)
+        if tokens is None:
+            tokens = self._encode(segments, prefix_lang=prefix_lang)
+
+        fallback_score = self._decoder_ops.decoder_greedy_fallback_score
+        if beam_size is not None or fallback_score is None or self._beam_size == 1:
+            return self._decode_buckets(source_lang, target_lang, segments, tokens, prefix_lang=prefix_lang,
+                                        alignment=alignment, beam_size=beam_size or self._beam_size)
+
+        results = self._decode_buckets(source_lang, target_lang, segments, tokens, prefix_lang=prefix_lang,
+                                       alignment=alignment, beam_size=1)
+
+        fallback = [i for i, translation in enumerate(results) if translation.score < fallback_score]
+        if len(fallback) > 0:
+            translations = self._decode_buckets(source_lang, target_lang, [segments[i] for i in fallback],
+                                                [tokens[i] for i in fallback], prefix_lang=prefix_lang,
+                                                alignment=alignment, beam_size=self._beam_size)
+            for i, translation in zip(fallback, translations):
+                results[i] = translation
+
+        self._logger.info('greedy_fallback = %d/%d' % (len(fallback), len(segments)))
+        return results
+
+    def _decode_buckets(self, source_lang, target_lang, segments, tokens, prefix_lang=None, alignment=True,
+                        beam_size=None):
+        buckets = self._make_buckets(tokens)
+        if len(buckets) == 1:
+            return self._decode_batch(source_lang, target_lang, segments, tokens, prefix_lang=prefix_lang,
+                                      alignment=alignment, beam_size=beam_size)
+
+        results = [None] * len(segments)
+        for bucket in buckets:
+            translations = self._decode_batch(source_lang, target_lang,
+                                              [segments[i] for i in bucket], [tokens[i] for i in bucket],
+                                              prefix_lang=prefix_lang, alignment=alignment, beam_size=beam_size)
+            for i, translation in zip(bucket, translations):
+                results[i] = translation
+
+        return results
+
+    def _make_buckets(self, tokens):
+        # Split the batch in sub-batches of similar length, so that the padded size of each one
+        # (number of segments * longest segment) does not exceed decoder_max_batch_tokens
+        max_tokens = self._decoder_ops.decoder_max_batch_tokens
+        if max_tokens is None or len(tokens) < 2:
+            return [list(range(len(tokens)))]
+
+        buckets, bucket = [], []
+        for i in sorted(range(len(tokens)), key=lambda j: tokens[j].numel()):
+            if len(bucket) > 0 and (len(bucket) + 1) * tokens[i].numel() > max_tokens:
+                buckets.append(bucket)
+                bucket = []
+            bucket.append(i)
+        buckets.append(bucket)
+
+        return buckets
+
+    def _get_translator(self, beam_size):
+        # Generators are cached by beam size: they all share the same model
+        if beam_size == self._beam_size:
+            translator = self._translator
+        elif beam_size in self._instance.translators:
+            translator = self._instance.translators[beam_size]
+        else:
+            translator = self._create_translator([self._model], self._checkpoints, beam_size)
+            self._instance.translators[beam_size] = translator
+
+        return translator
+
+    def _decode_batch(self, source_lang, target_lang, segments, tokens, prefix_lang=None, alignment=True,
+                      beam_size=None):
+        batch, input_indexes, sentence_len = self._make_decode_batch(segments, tokens=tokens)
+        translator = self._get_translator(beam_size or self._beam_size)
 
         # Compute translation
-        self._translator.max_len_b = self._checkpoint.decode_length(source_lang, target_lang, sentence_len)
-        translations = self._translator.generate([self._model], batch)
+        max_lengths = self._checkpoint.decode_length(source_lang, target_lang, torch.arange(int(sentence_len) + 1))
+        translator.max_len_b = int(max_lengths[-1])
+        if self._decoder_ops.decoder_sentence_max_length:
+            self._max_lengths = max_lengths if self._device is None else max_lengths.cuda(self._device)
+
+        if self._decoder_ops.decoder_shortlist:
+            self._set_shortlist(tokens)
+
+        self._set_need_attn(alignment)
+        try:
+            translations = translator.generate([self._model], batch)
+        finally:
+            self._set_need_attn(True)
+            self._max_lengths = None
+            self._shortlist = None
 
         # Decode translation
         sub_dict = self._checkpoint.subword_dictionary
 
+        hypos = [hypo[0] for hypo in translations]  # (top-1 best nbest)
+        hypos_indexes = [sub_dict.indexes_of(hypo['tokens']) for hypo in hypos]
+
+        # Make alignment
+        aligned = [i for i, hypo_indexes in enumerate(hypos_indexes) if alignment and len(hypo_indexes) > 0]
+        alignments = make_alignments([input_indexes[i] for i in aligned], [hypos_indexes[i] for i in aligned],
+                                     [hypos[i]['attention'] for i in aligned], prefix_lang=prefix_lang is not None)
+        alignments = dict(zip(aligned, alignments))
+
         results = []
-        for i, hypo in enumerate(translations):
-            hypo = hypo[0]  # (top-1 best nbest)
+        for i, hypo in enumerate(hypos):
             hypo_score = math.exp(hypo['score'])
-            hypo_tokens = hypo['tokens']
-            hypo_indexes = sub_dict.indexes_of(hypo_tokens)
-            hypo_str = sub_dict.string(hypo_tokens)
-            hypo_attention = np.asarray(hypo['attention'].data.cpu())
-
-            # Make alignment
-            if len(hypo_indexes) > 0:
-                hypo_alignment = make_alignment(input_indexes[i], hypo_indexes, hypo_attention,
-                                                prefix_lang=prefix_lang is not None)
-                hypo_alignment = clean_alignment(hypo_alignment, segments[i], hypo_str)
+            hypo_str = sub_dict.string(hypo['tokens'])
+
+            if i in alignments:
+                hypo_alignment = clean_alignment(alignments[i], segments[i], hypo_str)
             else:
-                hypo_alignment = []
+                hypo_alignment = [] if alignment else None
 
             results.append(Translation(hypo_str, alignment=hypo_alignment, score=hypo_score))
 
         return results
 
-    def _force_decode(self, target_lang, segments, translations):
+    def _force_decode(self, target_lang, segments, translations, alignment=True):
+        if not alignment:
+            return [Translation(translation) for translation in translations]
+
         prefix_lang = target_lang if self._checkpoint.multilingual_target else None
 
         batch = self._make_force_decode_batch(segments, translations, prefix_lang=prefix_lang)
@@ -338,24 +1017,25 @@ class MMTDecoder(object):
         if type(attn) is list:
             attn = attn[0]
 
-        results = []
+        attentions = []
         for i, hypo_attention in enumerate(attn):  # for each entry of the original batch
-            hypo_attention = hypo_attention.transpose(0, 1).cpu()
-            hypo_attention = hypo_attention[hypo_attention.size(0) - (len(src_indexes[i]) + 1):,
-                             hypo_attention.size(1) - (len(tgt_indexes[i]) + 1):]
+            hypo_attention = hypo_attention.transpose(0, 1)
+            attentions.append(hypo_attention[hypo_attention.size(0) - (len(src_indexes[i]) + 1):,
+                                             hypo_attention.size(1) - (len(tgt_indexes[i]) + 1):])
 
-            # Make alignment
-            hypo_alignment = make_alignment(src_indexes[i], tgt_indexes[i], hypo_attention.data.numpy(),
-                                            prefix_lang=prefix_lang is not None)
+        # Make alignment
+        alignments = make_alignments(src_indexes, tgt_indexes, attentions, prefix_lang=prefix_lang is not None)
 
+        results = []
+        for i, hypo_alignment in enumerate(alignments):
             hypo_alignment = clean_alignment(hypo_alignment, segments[i], translations[i])
-
             results.append(Translation(translations[i], alignment=hypo_alignment))
 
         return results
 
-    def _make_decode_batch(self, segments, prefix_lang=None):
-        src_tokens, src_indexes, src_lengths, src_max_length = self._make_batch(segments, prefix_lang=prefix_lang)
+    def _make_decode_batch(self, segments, prefix_lang=None, tokens=None):
+        src_tokens, src_indexes, src_lengths, src_max_length = \
+            self._make_batch(segments, prefix_lang=prefix_lang, tokens=tokens)
 
         batch = {'net_input': {
             'src_tokens': src_tokens,
@@ -376,19 +1056,25 @@ class MMTDecoder(object):
             'src_lengths': src_lengths
         }
 
-    def _make_batch(self, entries, prefix_lang=None, reverse_last_word=False):
+    def _encode(self, entries, prefix_lang=None, checkpoint=None):
+        sub_dict = (checkpoint or self._checkpoint).subword_dictionary
+
         # Add language prefix if multilingual target
         if prefix_lang is not None:
-            entries = [self._checkpoint.subword_dictionary.language_tag(prefix_lang) + ' ' + text for text in entries]
+            entries = [sub_dict.language_tag(prefix_lang) + ' ' + text for text in entries]
+
+        return [
+            sub_dict.encode_line(text, line_tokenizer=sub_dict.tokenize, add_if_not_exist=False).long()
+            for text in entries
+        ]
 
+    def _make_batch(self, entries, prefix_lang=None, reverse_last_word=False, tokens=None):
         # Prepare batch
         if len(entries) > 0:
             sub_dict = self._checkpoint.subword_dictionary
 
-            tokens = [
-                sub_dict.encode_line(text, line_tokenizer=sub_dict.tokenize, add_if_not_exist=False).long()
-                for text in entries
-            ]
+            if tokens is None:
+                tokens = self._encode(entries, prefix_lang=prefix_lang)
             indexes = [sub_dict.indexes_of(el) for el in tokens]
             lengths = torch.LongTensor([t.numel() for t in tokens])
 
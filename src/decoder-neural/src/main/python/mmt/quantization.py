@@ -0,0 +1,126 @@
+import json
+import math
+import os
+from collections import defaultdict
+
+import torch
+from fairseq.modules import MultiheadAttention
+
+CALIBRATION_FILE = 'model.qnt'
+
+
+def load_calibration(checkpoint_path):
+    # returns the names of the layers excluded from int8 quantization (none if the checkpoint is not calibrated)
+    calibration_path = os.path.join(checkpoint_path, CALIBRATION_FILE)
+    if not os.path.isfile(calibration_path):
+        return []
+
+    with open(calibration_path, 'r', encoding='utf-8') as f:
+        return json.load(f)['excluded']
+
+
+def save_calibration(checkpoint_path, excluded, errors, max_error):
+    with open(os.path.join(checkpoint_path, CALIBRATION_FILE), 'w', encoding='utf-8') as f:
+        json.dump({'max_error': max_error, 'excluded': excluded, 'errors': errors}, f, indent=2)
+
+
+def _pack(module):
+    # symmetric int8 weights with one scale for every output channel
+    weight = module.weight.detach().float()
+    scales = (weight.abs().max(dim=1)[0] / 127.).clamp(min=1e-8).double()
+    zero_points = torch.zeros(weight.size(0), dtype=torch.long)
+
+    qweight = torch.quantize_per_channel(weight, scales, zero_points, 0, torch.qint8)
+    bias = module.bias.detach().float() if module.bias is not None else None
+
+    return torch.ops.quantized.linear_prepack(qweight, bias)
+
+
+def _linear_int8(x, packed):
+    # activations are quantized per tensor at every call (reduce_range as torch dynamic quantized Linear)
+    return torch.ops.quantized.linear_dynamic(x, packed, True)
+
+
+class LinearQuantizer(object):
+    """
+    Dynamic int8 quantization of the Linear layers of a model on CPU: weights are quantized per output channel,
+    activations per tensor at every call. Float parameters are left in place, so load_state_dict(), tuning and
+    partial restores keep working on them: quantize() and update() pack the int8 copies of the weights again.
+    Layers run in float while the model is in training mode, or if excluded by the checkpoint calibration.
+    """
+
+    def __init__(self):
+        self._model = None
+        self._modules = {}
+        self._packed = {}
+        self.enabled = True
+
+    def install(self, model):
+        self._model = model
+
+        for name, module in model.named_modules():
+            if isinstance(module, torch.nn.Linear):
+                self._modules[name] = module
+                self._bind(name, module)
+            elif isinstance(module, MultiheadAttention):
+                # the fused PyTorch attention reads the projection weights without calling the Linear layers
+                module.skip_embed_dim_check = True
+
+        return model
+
+    def quantize(self, excluded=None):
+        excluded = set(excluded or [])
+        self._packed = {name: _pack(module) for name, module in self._modules.items() if name not in excluded}
+
+    def update(self, parameter_names):
+        # pack again the quantized layers owning one of the given parameters (it can be shared, like tied embeddings)
+        parameters = dict(self._model.named_parameters())
+        updated = set(id(parameters[name]) for name in parameter_names if name in parameters)
+
+        for name in self._packed:
+            module = self._modules[name]
+            if id(module.weight) in updated or (module.bias is not None and id(module.bias) in updated):
+                self._packed[name] = _pack(module)
+
+    def calibrate(self, run, max_error):
+        """
+        Calls run() with the model in float and measures for every layer the relative error of its int8 output
+        (L2 norm of the difference divided by L2 norm of the float output, on all the inputs seen by the layer).
+        Returns the list of the layers whose error is greater than max_error, and the errors of all the layers.
+        """
+        squared_errors, squared_norms = defaultdict(float), defaultdict(float)
+
+        def _hook(name, packed):
+            def hook(_, inputs, output):
+                squared_errors[name] += (_linear_int8(inputs[0], packed) - output).pow(2).sum().item()
+                squared_norms[name] += output.pow(2).sum().item()
+
+            return hook
+
+        hooks = [module.register_forward_hook(_hook(name, _pack(module))) for name, module in self._modules.items()]
+        enabled, self.enabled = self.enabled, False
+
+        try:
+            with torch.no_grad():
+                run()
+        finally:
+            self.enabled = enabled
+            for hook in hooks:
+                hook.remove()
+
+        errors = {name: math.sqrt(squared_errors[name] / squared_norms[name]) if squared_norms[name] > 0 else 0.
+                  for name in self._modules}
+        excluded = [name for name, error in errors.items() if error > max_error]
+
+        return excluded, errors
+
+    def _bind(self, name, module):
+        _forward = module.forward
+
+        def forward(x):
+            packed = self._packed.get(name)
+            if packed is None or not self.enabled or module.training or x.dtype != torch.float32 or x.is_cuda:
+                return _forward(x)
+            return _linear_int8(x, packed)
+
+        module.forward = forward
@@ -0,0 +1,46 @@
+import os
+
+import torch
+
+LEXICAL_TABLE_FILE = 'model.lex'
+
+
+def load_lexical_table(checkpoint_path, dictionary):
+    """
+    Loads the lexical table of a checkpoint (if any): every line of the file lists a source subword followed
+    by its candidate translations, as subwords of model.vcb separated by spaces. Subwords not in the dictionary
+    are ignored. Returns a dict source subword id -> list of target subword ids.
+    """
+    table_path = os.path.join(checkpoint_path, LEXICAL_TABLE_FILE)
+    if not os.path.isfile(table_path):
+        return {}
+
+    table = {}
+    with open(table_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            subwords = line.split()
+            if len(subwords) < 2 or subwords[0] not in dictionary.indices:
+                continue
+
+            table[dictionary.indices[subwords[0]]] = \
+                [dictionary.indices[subword] for subword in subwords[1:] if subword in dictionary.indices]
+
+    return table
+
+
+def make_shortlist(dictionary, tokens, lexical_table=None, frequent=0):
+    """
+    Returns the sorted ids of the target subwords that can be generated for a batch of source tokens: the source
+    subwords themselves (names, numbers and other copied words), their candidates in lexical_table, the first
+    `frequent` subwords of the dictionary (sorted by frequency) and the special symbols.
+    """
+    source_ids = torch.cat([t.view(-1) for t in tokens]).unique().tolist() if len(tokens) > 0 else []
+
+    ids = set(range(min(dictionary.nspecial + frequent, dictionary.original_size)))
+    ids.update(i for i in source_ids if i < dictionary.original_size)
+
+    if lexical_table:
+        for i in source_ids:
+            ids.update(lexical_table.get(i, []))
+
+    return torch.tensor(sorted(ids), dtype=torch.long)
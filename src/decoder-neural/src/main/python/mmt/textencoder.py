@@ -2,13 +2,16 @@ import collections
 import logging
 import multiprocessing
 import os
+import pickle
 import re
 import tempfile
+import threading
 from itertools import chain
 
 import cachetools
 import torch
 from fairseq.data import Dictionary
+from fairseq.tokenizer import tokenize_line
 
 PAD = "<PAD>_"
 EOS = "<EOS>_"
@@ -376,7 +379,9 @@ class SubwordDictionary(Dictionary):
         self.nspecial = len(RESERVED_TOKENS)
 
         self._cache = cachetools.LRUCache(maxsize=2 ** 20)
+        self._cache_lock = threading.RLock()
         self._max_subtoken_len = 0
+        self._trie = None
         self._alphabet = set()
         self._original_size = None
 
@@ -387,11 +392,24 @@ class SubwordDictionary(Dictionary):
     def _init_subtokens_from_list(self, subtokens):
         self.symbols = subtokens
         self.indices = {s: i for i, s in enumerate(subtokens) if s}
+        self._trie = None
 
         # we remember the maximum length of any subtoken to avoid having to
         # check arbitrarily long strings.
         self._max_subtoken_len = max([len(s) for s in subtokens])
 
+    def _build_trie(self):
+        # nested dicts char -> node, the id of the subtoken ending in a node (if any) is stored with key ''
+        trie = {}
+        for subtoken, subtoken_id in self.indices.items():
+            node = trie
+            for c in subtoken:
+                node = node.setdefault(c, {})
+            node[''] = subtoken_id
+
+        self._trie = trie
+        return trie
+
     def _init_alphabet_from_tokens(self, tokens):
         # Include all characters from all tokens in the alphabet to guarantee that
         # any token can be encoded. Additionally, include all escaping characters.
@@ -479,6 +497,36 @@ class SubwordDictionary(Dictionary):
         for symbol in self.symbols:
             print("'{}'".format(symbol), file=f)
 
+    @classmethod
+    def load_indexed(cls, f):
+        if isinstance(f, str):
+            with open(f, 'rb') as fd:
+                return cls.load_indexed(fd)
+
+        state = pickle.load(f)
+
+        dictionary = cls()
+        dictionary.symbols = state['symbols']
+        dictionary.indices = state['indices']
+        dictionary._alphabet = state['alphabet']
+        dictionary._max_subtoken_len = state['max_subtoken_len']
+        dictionary._original_size = state['original_size']
+        return dictionary
+
+    def save_indexed(self, f):
+        # unlike save(), it stores the indices and the alphabet too, so that load_indexed() does not rebuild them
+        if isinstance(f, str):
+            with open(f, 'wb') as fd:
+                return self.save_indexed(fd)
+
+        pickle.dump({
+            'symbols': self.symbols,
+            'indices': self.indices,
+            'alphabet': self._alphabet,
+            'max_subtoken_len': self._max_subtoken_len,
+            'original_size': self._original_size
+        }, f, protocol=pickle.HIGHEST_PROTOCOL)
+
     def indexes_of(self, subtoken_ids):
         indexes = []
         i = 0
@@ -540,32 +588,64 @@ class SubwordDictionary(Dictionary):
         return subtokens
 
     def tokenize(self, raw_text):
+        return [self.symbols[i] for i in self.tokenize_ids(raw_text)]
+
+    def tokenize_ids(self, raw_text):
         ret = []
         for token in raw_text.strip().split():
-            ret.extend(self._subtokens_of(token))
+            ret.extend(self._subtoken_ids_of(token))
         return ret
 
-    @cachetools.cachedmethod(cache=lambda self: self._cache, key=lambda token: token)
-    def _subtokens_of(self, token):
-        return self._subtokens_of_escaped(_escape_token(token, self._alphabet))
+    def encode_line(self, line, line_tokenizer=tokenize_line, add_if_not_exist=True, consumer=None, append_eos=True,
+                    reverse_order=False):
+        # with tokenize() the subword ids are computed directly, without looking up every subtoken again
+        if line_tokenizer != self.tokenize or add_if_not_exist or consumer is not None:
+            return super().encode_line(line, line_tokenizer=line_tokenizer, add_if_not_exist=add_if_not_exist,
+                                       consumer=consumer, append_eos=append_eos, reverse_order=reverse_order)
+
+        ids = self.tokenize_ids(line)
+        if reverse_order:
+            ids = ids[::-1]
+        if append_eos:
+            ids = ids + [self.eos_index]
+
+        return torch.IntTensor(ids)
+
+    @cachetools.cachedmethod(cache=lambda self: self._cache, key=lambda token: token,
+                             lock=lambda self: self._cache_lock)
+    def _subtoken_ids_of(self, token):
+        ret = self._subtoken_ids_of_escaped(_escape_token(token, self._alphabet))
+        return ret if ret is not None else [self.unk_index]
 
     def _subtokens_of_escaped(self, escaped_token):
+        ret = self._subtoken_ids_of_escaped(escaped_token)
+        return [self.symbols[i] for i in ret] if ret is not None else [self.unk_string()]
+
+    def _subtoken_ids_of_escaped(self, escaped_token):
         # NOTE: This algorithm is greedy; it won't necessarily produce the "best"
-        # list of subtokens.
+        # list of subtokens: at every position, the longest subtoken is matched walking the trie.
+        trie = self._trie if self._trie is not None else self._build_trie()
+
         ret = []
         start = 0
         token_len = len(escaped_token)
         while start < token_len:
-            for end in range(
-                    min(token_len, start + self._max_subtoken_len), start, -1):
-                subtoken = escaped_token[start:end]
-                if subtoken in self.indices:
-                    ret.append(subtoken)
-                    start = end
+            node, match, end = trie, None, start
+            for position in range(start, token_len):
+                node = node.get(escaped_token[position])
+                if node is None:
                     break
-            else:  # Did not break
+
+                subtoken_id = node.get('')
+                if subtoken_id is not None:
+                    match, end = subtoken_id, position + 1
+
+            if match is None:
                 # If there is no possible encoding of the escaped token then one of the
                 # characters in the token is not in the alphabet.
-                return [self.unk_string()]
+                return None
+
+            ret.append(match)
+            start = end
 
         return ret
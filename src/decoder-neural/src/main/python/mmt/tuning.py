@@ -1,13 +1,20 @@
 import logging
 import math
+import time
 
+import cachetools
 import numpy as np
 import torch
 from fairseq import optim, utils
-from fairseq.data import LanguagePairDataset
+from fairseq.data import data_utils
 
 from mmt import is_fairseq_0_12
 
+try:
+    from torch.func import functional_call
+except ImportError:  # torch < 2.0
+    from torch.nn.utils.stateless import functional_call
+
 
 class TuningOptions(object):
     def __init__(self):
@@ -16,41 +23,131 @@ class TuningOptions(object):
         self.tuning_max_epochs = 4
         self.tuning_max_learning_rate = .0001
         self.tuning_max_batch_size = 4000
+        self.tuning_delta_restore = True
+        self.tuning_scope = 'all'  # all, decoder, decoder_layers (the last tuning_scope_layers) or bias
+        self.tuning_scope_layers = 1
+        self.tuning_reuse_optimizer = False  # keeps the optimizer state (2x the tuned parameters with Adam) in memory
 
     def __str__(self):
         return str(self.__dict__)
 
 
-class TuningDataset(torch.utils.data.Dataset):
-    def __init__(self, lines, dictionary, append_eos=True, reverse_order=False):
-        self._tokens_list = [
-            dictionary.encode_line(line.strip(), line_tokenizer=dictionary.tokenize,
-                                   add_if_not_exist=False, append_eos=append_eos,
-                                   reverse_order=reverse_order).long()
-            for line in lines]
-        self._sizes = np.array([len(tokens) for tokens in self._tokens_list])
-        self._size = len(self._tokens_list)
-
-    def __getitem__(self, i):
-        if i < 0 or i >= self._size:
-            raise IndexError
+class TuningDataset(object):
+    """
+    Encoded source and target lines of the suggestions, collated directly into training batches: they are grouped
+    as the fairseq batch iterator of a LanguagePairDataset would do (sorted by length, then up to max_tokens per
+    batch), without building the dataset and the iterator at every tuning.
+    """
 
-        return self._tokens_list[i]
+    def __init__(self, src_tokens_list, tgt_tokens_list, dictionary, max_positions=(4096, 4096)):
+        self._src_tokens_list = src_tokens_list
+        self._tgt_tokens_list = tgt_tokens_list
+        self._pad, self._eos = dictionary.pad(), dictionary.eos()
+        self._src_sizes = np.array([len(tokens) for tokens in src_tokens_list], dtype=np.int64)
+        self._tgt_sizes = np.array([len(tokens) for tokens in tgt_tokens_list], dtype=np.int64)
+        self._dictionary = dictionary
+        self._max_positions = max_positions
 
     def __len__(self):
-        return self._size
+        return len(self._src_tokens_list)
 
     @property
     def sizes(self):
-        return self._sizes
-
-    @property
-    def tokens(self):
-        return self._tokens_list
+        # number of tokens (source and target) of every pair
+        return self._src_sizes + self._tgt_sizes
+
+    def select(self, indices):
+        return TuningDataset([self._src_tokens_list[i] for i in indices], [self._tgt_tokens_list[i] for i in indices],
+                             self._dictionary, max_positions=self._max_positions)
+
+    def batches(self, max_tokens):
+        # sorted by target length, then source length: ties are broken by a fixed permutation (seed 1),
+        # as the fairseq batch iterator does
+        indices = np.random.RandomState(1).permutation(len(self)).astype(np.int64)
+        indices = indices[np.argsort(self._tgt_sizes[indices], kind='mergesort')]
+        indices = indices[np.argsort(self._src_sizes[indices], kind='mergesort')]
+
+        max_src_positions, max_tgt_positions = self._max_positions
+        indices = [i for i in indices
+                   if self._src_sizes[i] <= max_src_positions and self._tgt_sizes[i] <= max_tgt_positions]
+
+        batch, batch_max_size = [], 0
+        for i in indices:
+            size = max(self._src_sizes[i], self._tgt_sizes[i])
+            if len(batch) > 0 and (len(batch) + 1) * max(batch_max_size, size) > max_tokens:
+                yield self._collate(batch)
+                batch, batch_max_size = [], 0
+
+            batch.append(i)
+            batch_max_size = max(batch_max_size, size)
+
+        if len(batch) > 0:
+            yield self._collate(batch)
+
+    def _collate(self, indices):
+        src_tokens = data_utils.collate_tokens([self._src_tokens_list[i] for i in indices], self._pad, self._eos,
+                                               left_pad=True)
+        src_lengths, sort_order = torch.LongTensor([self._src_sizes[i] for i in indices]).sort(descending=True)
+
+        tgt_tokens_list = [self._tgt_tokens_list[i] for i in indices]
+        target = data_utils.collate_tokens(tgt_tokens_list, self._pad, self._eos, left_pad=False)
+        prev_output_tokens = data_utils.collate_tokens(tgt_tokens_list, self._pad, self._eos, left_pad=False,
+                                                       move_eos_to_beginning=True)
+
+        return {
+            'id': torch.LongTensor(indices).index_select(0, sort_order),
+            'nsentences': len(indices),
+            'ntokens': int(sum(self._tgt_sizes[i] for i in indices)),
+            'net_input': {
+                'src_tokens': src_tokens.index_select(0, sort_order),
+                'src_lengths': src_lengths,
+                'prev_output_tokens': prev_output_tokens.index_select(0, sort_order),
+            },
+            'target': target.index_select(0, sort_order),
+        }
+
+
+class _Reparametrized(torch.nn.Module):
+    # calls a function while the parameters of model are replaced by the ones given to functional_call()
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+
+
+class ParameterDelta(object):
+    """
+    Parameters of a single request, stored as deltas over the base weights of the model (that are never modified):
+    apply() calls a function with every tuned parameter replaced by base + delta, using functional_call().
+    Tied parameters (e.g. shared embeddings) are replaced under all their names.
+    """
+
+    def __init__(self, model, names):
+        parameters = dict(model.named_parameters())
+
+        self._module = _Reparametrized(model)
+        self._base = {name: parameters[name] for name in names}
+        self._deltas = {name: torch.zeros_like(parameters[name], requires_grad=True) for name in names}
+
+        names_by_id = {id(parameter): name for name, parameter in self._base.items()}
+        self._aliases = [(alias, names_by_id[id(tensor)]) for alias, tensor in model.state_dict(keep_vars=True).items()
+                         if id(tensor) in names_by_id]
+
+    def parameters(self):
+        return list(self._deltas.values())
+
+    def apply(self, fn, *args, **kwargs):
+        tensors = {name: self._base[name].detach() + delta for name, delta in self._deltas.items()}
+        return functional_call(self._module, {'model.' + alias: tensors[name] for alias, name in self._aliases},
+                               (fn,) + args, kwargs)
 
 
 class Tuner(object):
-    def __init__(self, args, task, model, tuning_ops, device=None):
+    _ENCODED_CACHE_SIZE = 10000
+
+    def __init__(self, args, task, model, tuning_ops, device=None, copy_on_write=False):
         self._logger = logging.getLogger('Tuner')
 
         self._cuda = torch.cuda.is_available() and device is not None
@@ -59,32 +156,105 @@ class Tuner(object):
         self._task = task
 
         self._model = model
+        self._copy_on_write = copy_on_write
+        self._updated_parameters = set()
+        self._freeze_parameters()
+        self._optimizer = None
+        self._token_cost = None  # seconds per token of a training step, measured on the previous tunings
+        self._encoded = cachetools.LRUCache(maxsize=self._ENCODED_CACHE_SIZE)
 
         self._criterion = task.build_criterion(args)
         if self._cuda:
             self._criterion = self._criterion.cuda()
 
         self.__train_step_kwargs = {'ignore_grad': False}
-        self.__dataset_kwargs = {'left_pad_source': True, 'left_pad_target': False}
 
         if is_fairseq_0_12():
             self.__train_step_kwargs['update_num'] = 1
-        else:
-            self.__dataset_kwargs['max_source_positions'] = 4096
-            self.__dataset_kwargs['max_target_positions'] = 4096
+
+    @property
+    def updated_parameters(self):
+        # names of the parameters modified by tune() since the last call to clear_updated_parameters()
+        return self._updated_parameters
+
+    def clear_updated_parameters(self):
+        self._updated_parameters = set()
 
     def dataset(self, src_samples, tgt_samples, dictionary):
-        src_dataset = TuningDataset(src_samples, dictionary)
-        tgt_dataset = TuningDataset(tgt_samples, dictionary)
+        return TuningDataset([self._encode(line, dictionary) for line in src_samples],
+                             [self._encode(line, dictionary) for line in tgt_samples], dictionary)
+
+    def _encode(self, line, dictionary):
+        # recurring suggestions are encoded once: the cached entry keeps a reference to its dictionary,
+        # so that the id in the key cannot be reused by another one
+        key = (id(dictionary), line)
+        entry = self._encoded.get(key)
+
+        if entry is None:
+            tokens = dictionary.encode_line(line.strip(), line_tokenizer=dictionary.tokenize,
+                                            add_if_not_exist=False, append_eos=True).long()
+            entry = self._encoded[key] = (dictionary, tokens)
+
+        return entry[1]
+
+    def _get_optimizer(self):
+        # With tuning_reuse_optimizer, the optimizer is built once (until release()) and its state buffers
+        # (Adam moments) are zeroed in place at every tuning: they are not counted by decoder_model_pool_mb.
+        # FP16 optimizers keep fp32 copies of the weights, stale after a model reset: they are built every time.
+        if self._args.fp16 or not self._tuning_ops.tuning_reuse_optimizer:
+            return self._build_optimizer()
+
+        if self._optimizer is None:
+            self._optimizer = self._build_optimizer()
+        else:
+            for state in self._optimizer.optimizer.state.values():
+                for key, value in state.items():
+                    if torch.is_tensor(value):
+                        value.zero_()
+                    else:
+                        state[key] = 0
+
+        return self._optimizer
+
+    def release(self):
+        # drops the optimizer and its state buffers (twice the size of the tuned parameters with Adam),
+        # built again by the next tuning
+        self._optimizer = None
+
+    def _freeze_parameters(self):
+        # Parameters outside the tuning scope do not require grad: backward stops at the first tuned layer
+        # and the optimizer (built on the parameters requiring grad) only updates the tuned ones
+        scope = self._tuning_ops.tuning_scope
+
+        if scope == 'all':
+            return
+        elif scope == 'decoder':
+            modules = [self._model.decoder]
+        elif scope == 'decoder_layers':
+            layers = self._tuning_ops.tuning_scope_layers
+            if not 0 < layers <= len(self._model.decoder.layers):
+                raise ValueError('Invalid tuning_scope_layers "%s"' % str(layers))
+
+            modules = list(self._model.decoder.layers[-layers:])
+            if getattr(self._model.decoder, 'layer_norm', None) is not None:
+                modules.append(self._model.decoder.layer_norm)
+        elif scope == 'bias':
+            # LayerNorm may be the fused implementation of apex, not a subclass of torch.nn.LayerNorm
+            modules = [module for module in self._model.modules() if 'LayerNorm' in type(module).__name__]
+        else:
+            raise ValueError('Invalid tuning_scope "%s"' % str(scope))
+
+        tuned = set(id(p) for module in modules for p in module.parameters())
+        if scope == 'bias':
+            tuned.update(id(p) for name, p in self._model.named_parameters() if name.endswith('.bias'))
 
-        return LanguagePairDataset(
-            src_dataset, src_dataset.sizes, dictionary,
-            tgt_dataset, tgt_dataset.sizes, dictionary,
-            **self.__dataset_kwargs
-        )
+        for p in self._model.parameters():
+            if id(p) not in tuned:
+                p.requires_grad_(False)
 
-    def _build_optimizer(self):
-        params = list(filter(lambda p: p.requires_grad, self._model.parameters()))
+    def _build_optimizer(self, params=None):
+        if params is None:
+            params = list(filter(lambda p: p.requires_grad, self._model.parameters()))
         if self._args.fp16:
             if self._cuda and torch.cuda.get_device_capability(0)[0] < 7:
                 print('| WARNING: your device does NOT support faster training with --fp16, '
@@ -121,32 +291,72 @@ class Tuner(object):
 
         return tuning_epochs, tuning_learning_rate
 
-    def tune(self, dataset, num_iterations, lr):
+    def schedule(self, dataset, segments, suggestions, epochs, budget):
+        """
+        Fits the tuning on dataset (built from suggestions) in budget seconds, based on the cost per token measured
+        on the previous tunings: epochs are reduced first, down to one; then only the suggestions whose source
+        overlaps the most with the segments to translate are kept. Returns the dataset and the epochs to run:
+        0 if not even one suggestion fits in the budget.
+        """
+        if budget <= 0:
+            return dataset, 0
+        if self._token_cost is None or epochs == 0:
+            return dataset, epochs  # no measure yet, the first tuning runs as estimated
+
+        costs = dataset.sizes * self._token_cost
+        if costs.sum() * epochs <= budget:
+            return dataset, epochs
+        if costs.sum() <= budget:
+            return dataset, int(budget // costs.sum())
+
+        # fraction of the words of every suggestion found in the segments, the highest first (then the best score)
+        words = set(word for segment in segments for word in segment.split())
+        overlaps = [len(words.intersection(s.segment.split())) / max(len(s.segment.split()), 1) for s in suggestions]
+        ranking = sorted(range(len(suggestions)), key=lambda i: (-overlaps[i], -suggestions[i].score))
+
+        selected, cost = [], 0.
+        for i in ranking:
+            if cost + costs[i] <= budget:
+                selected.append(i)
+                cost += costs[i]
+
+        if len(selected) == 0:
+            return dataset, 0
+
+        return dataset.select(sorted(selected)), 1
+
+    def delta(self):
+        # a new (zero) ParameterDelta of the parameters in the tuning scope
+        return ParameterDelta(self._model, [name for name, p in self._model.named_parameters() if p.requires_grad])
+
+    def tune(self, dataset, num_iterations, lr, delta=None):
+        # With a ParameterDelta, only the delta is trained (with an optimizer of its own) and the model is untouched
         if len(dataset) == 0:
             return
 
-        epoch_itr = self._task.get_batch_iterator(
-            dataset=dataset,
-            max_tokens=self._tuning_ops.tuning_max_batch_size,
-            max_sentences=None,
-            max_positions=(4096, 4096),
-            ignore_invalid_inputs=True,
-            seed=1, num_shards=1, shard_id=0,
-        )
-
-        optimizer = self._build_optimizer()
+        optimizer = self._get_optimizer() if delta is None else self._build_optimizer(delta.parameters())
 
+        begin, tokens = time.time(), 0
         for step in range(num_iterations):
-            for sample in epoch_itr.next_epoch_itr(shuffle=False, fix_batches_to_gpus=False):
-                if len(sample) == 0:
-                    continue
+            for sample in dataset.batches(self._tuning_ops.tuning_max_batch_size):
+                tokens += sample['ntokens'] + sample['net_input']['src_lengths'].sum().item()
 
                 if self._cuda:
                     sample = utils.move_to_cuda(sample)
                 optimizer.set_lr(lr)
-                self._train_step(optimizer, sample, step)
+                if delta is None:
+                    self._train_step(optimizer, sample, step)
+                else:
+                    delta.apply(self._train_step, optimizer, sample, step)
                 del sample
 
+        if tokens > 0:
+            if self._cuda:
+                torch.cuda.synchronize()
+
+            token_cost = (time.time() - begin) / tokens
+            self._token_cost = token_cost if self._token_cost is None else .9 * self._token_cost + .1 * token_cost
+
     def _train_step(self, optimizer, sample, step=0):
         """Do forward, backward and parameter update."""
         seed = self._args.seed + step
@@ -170,6 +380,16 @@ class Tuner(object):
             else:
                 raise e
 
+        updated = [(name, p) for name, p in self._model.named_parameters() if p.grad is not None]
+
+        if self._copy_on_write:
+            # parameters may be views of weights shared with other models: they are copied before their first update
+            for name, p in updated:
+                if name not in self._updated_parameters:
+                    p.data = p.data.clone()
+
+        self._updated_parameters.update(name for name, _ in updated)
+
         try:
             optimizer.step()
         except OverflowError as e:
@@ -1,6 +1,11 @@
 import json
 import logging
+import queue
+import struct
 import sys
+import threading
+
+import torch
 
 from mmt.decoder import Suggestion
 
@@ -59,17 +64,24 @@ def mask_std_streams():
 
 
 class TranslationRequest(object):
-    def __init__(self, source_lang, target_lang, batch, suggestions=None, forced_translation=None):
+    def __init__(self, source_lang, target_lang, batch, suggestions=None, forced_translation=None, alignment=True,
+                 tokens=None, beam_size=None, latency_budget=None):
         self.source_lang = source_lang
         self.target_lang = target_lang
         self.batch = batch
         self.suggestions = suggestions if suggestions is not None else []
         self.forced_translation = forced_translation
+        self.alignment = alignment
+        self.tokens = tokens  # subword encoding of batch, if computed in advance (see MMTDecoder.encode)
+        self.beam_size = beam_size
+        self.latency_budget = latency_budget  # seconds
 
     @staticmethod
     def from_json_string(json_string):
-        obj = json.loads(json_string)
+        return TranslationRequest.from_json_object(json.loads(json_string))
 
+    @staticmethod
+    def from_json_object(obj):
         if len(obj) == 0:
             return TranslationRequest(None, None, None)  # Test request
 
@@ -80,6 +92,13 @@ class TranslationRequest(object):
         if 'f' in obj:
             forced_translation = obj['f'].split('\n')
 
+        # "a": false skips the computation of word alignment
+        alignment = bool(obj['a']) if 'a' in obj else True
+        # "b": N overrides the beam size of the decoder (1 is greedy decoding)
+        beam_size = int(obj['b']) if 'b' in obj else None
+        # "lb": N is the latency budget of the request in milliseconds (tuning is scheduled to fit in it)
+        latency_budget = float(obj['lb']) / 1000. if 'lb' in obj else None
+
         suggestions = []
 
         if 'hints' in obj:
@@ -92,8 +111,9 @@ class TranslationRequest(object):
 
                 suggestions.append(Suggestion(sugg_sl, sugg_tl, sugg_seg, sugg_tra, sugg_scr))
 
-        return TranslationRequest(source_lang, target_lang, batch,
-                                  suggestions=suggestions, forced_translation=forced_translation)
+        return TranslationRequest(source_lang, target_lang, batch, suggestions=suggestions,
+                                  forced_translation=forced_translation, alignment=alignment, beam_size=beam_size,
+                                  latency_budget=latency_budget)
 
 
 class TranslationResponse(object):
@@ -133,36 +153,263 @@ class TranslationResponse(object):
             'data': [__to_json(translation) for translation in translations],
         }).replace('\n', ' ')
 
+    @staticmethod
+    def to_bytes(obj):
+        if isinstance(obj, BaseException):
+            return TranslationResponse.__error_to_bytes(obj)
+        else:
+            return TranslationResponse.__translations_to_bytes(obj)
+
+    @staticmethod
+    def __string_to_bytes(string):
+        data = string.encode('utf-8')
+        return struct.pack('>I', len(data)) + data
+
+    @staticmethod
+    def __error_to_bytes(cause):
+        error_type = 'UnknownError' if isinstance(cause, str) else type(cause).__name__
+        msg = cause if isinstance(cause, str) else str(cause)
+
+        return b'\x00' + TranslationResponse.__string_to_bytes(error_type) + \
+            TranslationResponse.__string_to_bytes(msg)
+
+    @staticmethod
+    def __translations_to_bytes(translations):
+        chunks = [b'\x01', struct.pack('>I', len(translations))]
+
+        for translation in translations:
+            alignment = translation.alignment
+            score = translation.score
+            flags = (1 if score is not None else 0) | (2 if alignment is not None else 0)
+
+            chunks.append(TranslationResponse.__string_to_bytes(translation.text))
+            chunks.append(struct.pack('>B', flags))
+
+            if score is not None:
+                chunks.append(struct.pack('>f', score))
+            if alignment is not None:
+                size = len(alignment)
+                chunks.append(struct.pack('>I%dI%dI' % (size, size), size,
+                                          *[e[0] for e in alignment], *[e[1] for e in alignment]))
+
+        return b''.join(chunks)
+
+
+class _JSONChannel(object):
+    """
+    Default protocol: one JSON request per line, one JSON response per line
+    """
+
+    def __init__(self, stdin, stdout):
+        self._stdin = stdin
+        self._stdout = stdout
+
+    def read(self):
+        line = self._stdin.readline()
+        return json.loads(line) if line else None
+
+    def write(self, responses, window=False):
+        responses = [TranslationResponse.to_json_string(response) for response in responses]
+        # a window of queued requests is answered with the list of the corresponding responses
+        self._stdout.write(('[' + ', '.join(responses) + ']' if window else responses[0]) + '\n')
+        self._stdout.flush()
+
+
+class _BinaryChannel(object):
+    """
+    Binary protocol: every message is a frame made of its length (4 bytes, big-endian) followed by the payload.
+    Requests carry the same JSON objects (or lists of objects) of the line protocol, encoded in UTF-8;
+    every request of a window is answered with its own frame. A response frame contains:
+
+    - success: 0x01, count (uint32), then for each translation the text (uint32 length + UTF-8 bytes),
+      flags (uint8: 1 = score, 2 = alignment), score (float32) and alignment (uint32 size, then size uint32
+      source indexes and size uint32 target indexes) when present
+    - error: 0x00, then type and message (each one uint32 length + UTF-8 bytes)
+    """
+
+    def __init__(self, stdin, stdout):
+        self._stdin = stdin
+        self._stdout = stdout
+
+    def _read_exactly(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self._stdin.read(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def read(self):
+        header = self._read_exactly(4)
+        if header is None:
+            return None
+
+        payload = self._read_exactly(struct.unpack('>I', header)[0])
+        if payload is None:
+            return None
+
+        return json.loads(payload.decode('utf-8'))
+
+    def write(self, responses, window=False):
+        for response in responses:
+            payload = TranslationResponse.to_bytes(response)
+            self._stdout.write(struct.pack('>I', len(payload)))
+            self._stdout.write(payload)
+        self._stdout.flush()
+
+
+def _translate(decoder, request):
+    if request.batch is None:
+        decoder.test()
+        return []
+    else:
+        return decoder.translate(request.source_lang, request.target_lang, request.batch,
+                                 suggestions=request.suggestions,
+                                 forced_translation=request.forced_translation,
+                                 alignment=request.alignment, tokens=request.tokens, beam_size=request.beam_size,
+                                 latency_budget=request.latency_budget)
+
+
+def _negotiate_protocol(obj):
+    # protocol negotiation, sent by the client right after READY: {"protocol": "binary"}
+    if obj['protocol'] != 'binary':
+        raise ValueError('Unsupported protocol "%s"' % obj['protocol'])
+    return json.dumps({'success': True, 'protocol': obj['protocol']}) + '\n'
+
 
 def serve_forever(stdin, stdout, decoder):
     stdout.write('READY\n')
     stdout.flush()
 
+    # Work on the underlying byte streams (if any): the binary protocol cannot be read through a text wrapper
+    stdin = getattr(stdin, 'buffer', stdin)
+    channel = _JSONChannel(stdin, stdout)
+
     try:
         while True:
-            line = stdin.readline()
-            if not line:
+            obj = channel.read()
+            if obj is None:
                 break
 
-            request = TranslationRequest.from_json_string(line)
+            if isinstance(obj, dict) and 'protocol' in obj:
+                stdout.write(_negotiate_protocol(obj))
+                stdout.flush()
 
-            if request.batch is None:
-                decoder.test()
-                translations = []
+                channel = _BinaryChannel(stdin, getattr(stdout, 'buffer', stdout))
+            elif isinstance(obj, list):
+                requests = [TranslationRequest.from_json_object(e) for e in obj]
+                channel.write(decoder.translate_all(requests), window=True)
             else:
-                translations = decoder.translate(request.source_lang, request.target_lang, request.batch,
-                                                 suggestions=request.suggestions,
-                                                 forced_translation=request.forced_translation)
-
-            response = TranslationResponse.to_json_string(translations)
-
-            stdout.write(response + '\n')
-            stdout.flush()
+                channel.write([_translate(decoder, TranslationRequest.from_json_object(obj))])
     except KeyboardInterrupt:
         pass  # ignore and exit
     except BaseException as e:
-        response = TranslationResponse.to_json_string(e)
-        stdout.write(response + '\n')
-        stdout.flush()
+        channel.write([e])
 
         exit(1)
+
+
+_PROTOCOL, _REQUEST, _WINDOW, _ERROR = range(4)
+
+
+def serve_pipelined(stdin, stdout, decoder, queue_size=16):
+    """
+    Same protocol of serve_forever(), but requests are handled by three stages connected by bounded queues:
+    a reader thread that parses the requests and computes their subword encoding, a compute thread that owns
+    the model and the writer (the calling thread) that serializes the responses. Every message is numbered by
+    the reader, so responses are written in the order of the requests.
+    """
+    stdout.write('READY\n')
+    stdout.flush()
+
+    stdin = getattr(stdin, 'buffer', stdin)
+    requests_queue = queue.Queue(maxsize=queue_size)
+    responses_queue = queue.Queue(maxsize=queue_size)
+
+    def _encode(request):
+        if request.batch is not None and request.forced_translation is None:
+            try:
+                request.tokens = decoder.encode(request.source_lang, request.target_lang, request.batch)
+            except Exception:
+                pass  # the same error is raised (and reported) by the compute stage
+        return request
+
+    def _read():
+        channel = _JSONChannel(stdin, stdout)
+        seq = 0
+
+        try:
+            while True:
+                obj = channel.read()
+                if obj is None:
+                    break
+
+                if isinstance(obj, dict) and 'protocol' in obj:
+                    requests_queue.put((seq, _PROTOCOL, _negotiate_protocol(obj)))
+                    channel = _BinaryChannel(stdin, None)
+                elif isinstance(obj, list):
+                    requests_queue.put((seq, _WINDOW, [_encode(TranslationRequest.from_json_object(e)) for e in obj]))
+                else:
+                    requests_queue.put((seq, _REQUEST, _encode(TranslationRequest.from_json_object(obj))))
+
+                seq += 1
+        except BaseException as e:
+            requests_queue.put((seq, _ERROR, e))
+
+        requests_queue.put(None)
+
+    def _compute():
+        if decoder.device is not None:
+            torch.cuda.set_device(decoder.device)  # current device is a per-thread setting
+
+        while True:
+            item = requests_queue.get()
+            if item is None:
+                break
+
+            seq, kind, payload = item
+            try:
+                if kind == _REQUEST:
+                    payload = [_translate(decoder, payload)]
+                elif kind == _WINDOW:
+                    payload = decoder.translate_all(payload)
+            except BaseException as e:
+                kind, payload = _ERROR, e
+
+            responses_queue.put((seq, kind, payload))
+            if kind == _ERROR:
+                break  # the server exits once the error has been written
+
+        responses_queue.put(None)
+
+    for target in (_read, _compute):
+        threading.Thread(target=target, daemon=True).start()
+
+    channel = _JSONChannel(stdin, stdout)
+    pending, next_seq = {}, 0
+
+    try:
+        while True:
+            item = responses_queue.get()
+            if item is None:
+                break
+
+            seq, kind, payload = item
+            pending[seq] = (kind, payload)
+
+            while next_seq in pending:
+                kind, payload = pending.pop(next_seq)
+                next_seq += 1
+
+                if kind == _PROTOCOL:
+                    stdout.write(payload)
+                    stdout.flush()
+                    channel = _BinaryChannel(stdin, getattr(stdout, 'buffer', stdout))
+                elif kind == _ERROR:
+                    channel.write([payload])
+                    exit(1)
+                else:
+                    channel.write(payload, window=kind == _WINDOW)
+    except KeyboardInterrupt:
+        pass  # ignore and exit
@@ -0,0 +1,153 @@
+import logging
+import multiprocessing
+import os
+import signal
+
+import torch
+
+from mmt.decoder import MMTDecoder
+
+
+def _split(items, parts):
+    # split items in (at most) parts contiguous chunks of similar size
+    size, remainder = divmod(len(items), parts)
+    chunks, begin = [], 0
+    for i in range(parts):
+        end = begin + size + (1 if i < remainder else 0)
+        if end > begin:
+            chunks.append(items[begin:end])
+        begin = end
+    return chunks
+
+
+def _error(e):
+    # not all the exceptions can be pickled: they are sent by type name and message
+    return _WorkerError(type(e).__name__, str(e))
+
+
+class _WorkerError(object):
+    def __init__(self, type_name, message):
+        self.type_name = type_name
+        self.message = message
+
+    def exception(self):
+        return type(self.type_name, (Exception,), {})(self.message)
+
+
+def _worker_main(connection, checkpoints, num_threads, decoder_kwargs):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the parent handles interruption
+    torch.set_num_threads(num_threads)
+
+    try:
+        decoder = MMTDecoder(checkpoints, **decoder_kwargs)
+    except BaseException as e:
+        connection.send(_error(e))
+        return
+
+    connection.send(None)  # ready
+
+    while True:
+        try:
+            method, args, kwargs = connection.recv()
+        except EOFError:
+            break
+
+        try:
+            result = getattr(decoder, method)(*args, **kwargs)
+        except BaseException as e:
+            result = _error(e)
+
+        connection.send(result)
+
+
+class DecoderWorkers(object):
+    """
+    A pool of CPU decoders forked from the current process: checkpoints are loaded once by the parent and
+    the parameters of the model of every worker are views of their weights (see MMTDecoder share_weights):
+    tuning copies into the worker only the parameters it updates, for the time of the request. It exposes the same
+    interface of MMTDecoder used by the serve functions: batches and windows of requests are split among the workers.
+    """
+
+    def __init__(self, checkpoints, workers, num_threads=None, tuning_ops=None, decoder_ops=None):
+        if num_threads is None:
+            num_threads = max(1, (os.cpu_count() or 1) // workers)
+
+        self._logger = logging.getLogger('DecoderWorkers')
+        self._connections = []
+        self._processes = []
+
+        # weights are loaded before forking, so that all the workers share the parent's tensors
+        checkpoints.preload()
+
+        context = multiprocessing.get_context('fork')
+        decoder_kwargs = {'tuning_ops': tuning_ops, 'decoder_ops': decoder_ops, 'share_weights': True}
+
+        for _ in range(workers):
+            parent_connection, child_connection = context.Pipe()
+            process = context.Process(target=_worker_main, daemon=True,
+                                      args=(child_connection, checkpoints, num_threads, decoder_kwargs))
+            process.start()
+            child_connection.close()
+
+            self._connections.append(parent_connection)
+            self._processes.append(process)
+
+        self._next_worker = 0
+        self._receive_all(self._connections)
+        self._logger.info('started %d decoder workers (%d threads each)' % (workers, num_threads))
+
+    @property
+    def device(self):
+        return None
+
+    def encode(self, source_lang, target_lang, batch):
+        return None  # subword encoding is computed by the workers
+
+    def test(self):
+        self._call_all([('test', (), {})] * len(self._connections))
+
+    def translate(self, source_lang, target_lang, batch, suggestions=None, tuning_epochs=None,
+                  tuning_learning_rate=None, forced_translation=None, alignment=True, tokens=None, beam_size=None,
+                  latency_budget=None):
+        if (suggestions is None or len(suggestions) == 0) and forced_translation is None:
+            # plain decoding: every worker translates a slice of the batch
+            calls = [('translate', (source_lang, target_lang, chunk), {'alignment': alignment, 'beam_size': beam_size})
+                     for chunk in _split(batch, len(self._connections))]
+            return [translation for translations in self._call_all(calls) for translation in translations]
+        else:
+            connection = self._connections[self._next_worker]
+            self._next_worker = (self._next_worker + 1) % len(self._connections)
+
+            return self._call_all([('translate', (source_lang, target_lang, batch), {
+                'suggestions': suggestions, 'tuning_epochs': tuning_epochs, 'tuning_learning_rate': tuning_learning_rate,
+                'forced_translation': forced_translation, 'alignment': alignment, 'beam_size': beam_size,
+                'latency_budget': latency_budget
+            })], connections=[connection])[0]
+
+    def translate_all(self, requests):
+        # every worker translates a slice of the window (with MMTDecoder.translate_all)
+        calls = [('translate_all', (chunk,), {}) for chunk in _split(requests, len(self._connections))]
+        return [results for chunk_results in self._call_all(calls) for results in chunk_results]
+
+    def _call_all(self, calls, connections=None):
+        connections = connections or self._connections[:len(calls)]
+
+        for connection, call in zip(connections, calls):
+            connection.send(call)
+
+        return self._receive_all(connections)
+
+    @staticmethod
+    def _receive_all(connections):
+        results = []
+        for connection in connections:
+            try:
+                results.append(connection.recv())
+            except EOFError:
+                raise RuntimeError('decoder worker process died unexpectedly')
+
+        for result in results:
+            if isinstance(result, _WorkerError):
+                raise result.exception()
+
+        return results
@@ -0,0 +1,153 @@
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir,
+                                'src', 'decoder-neural', 'src', 'main', 'python'))
+
+import torch
+
+from mmt import alignment
+
+
+# Reference implementation: the original scan loops of the grow step, before coverage bitmaps and frontier queue
+
+def _aligned_o(o, ilen, points):
+    return any((i, o) in points for i in range(ilen))
+
+
+def _aligned_i(i, olen, points):
+    return any((i, o) in points for o in range(olen))
+
+
+def _scan_grow(i2o, o2i, ilen, olen, neighboring_points):
+    union = sorted(set(i2o) | set(o2i))
+    points = sorted(set(i2o) & set(o2i))
+
+    new_points_added = True
+    while new_points_added:
+        new_points_added = False
+        for i in range(ilen):
+            for o in range(olen):
+                if (i, o) in points:
+                    for (i_new, o_new) in neighboring_points(i, o, ilen, olen):
+                        if not (_aligned_o(o_new, ilen, points) and _aligned_i(i_new, olen, points)) \
+                                and ((i_new, o_new) in union):
+                            points.append((i_new, o_new))
+                            new_points_added = True
+
+    return points
+
+
+def _scan_grow_diagonal(i2o, o2i, ilen, olen):
+    # verbatim from the original sym_grow_diagonal: the diagonal loop is guarded by the flag left False by the first
+    points = _scan_grow(i2o, o2i, ilen, olen, alignment._neighboring_points_orthogonal)
+    union = sorted(set(i2o) | set(o2i))
+
+    new_points_added = False
+    while new_points_added:
+        new_points_added = False
+        for i in range(ilen):
+            for o in range(olen):
+                if (i, o) in points:
+                    for (i_new, o_new) in alignment._neighboring_points_diagonal(i, o, ilen, olen):
+                        if not (_aligned_o(o_new, ilen, points) and _aligned_i(i_new, olen, points)) \
+                                and ((i_new, o_new) in union):
+                            points.append((i_new, o_new))
+                            new_points_added = True
+
+    return points
+
+
+def _scan_final(points, i2o, o2i, ilen, olen):
+    for o in range(olen):
+        for i in range(ilen):
+            if not (_aligned_o(o, ilen, points) and _aligned_i(i, olen, points)) \
+                    and ((i, o) in i2o or (i, o) in o2i):
+                points.append((i, o))
+
+    return points
+
+
+class SymmetrizationTest(unittest.TestCase):
+    def _random_cases(self, count=500):
+        rnd = random.Random(1)
+        for _ in range(count):
+            ilen, olen = rnd.randint(1, 9), rnd.randint(1, 9)
+            density = rnd.random() * .5
+            i2o = [(i, o) for i in range(ilen) for o in range(olen) if rnd.random() < density]
+            o2i = [(i, o) for i in range(ilen) for o in range(olen) if rnd.random() < density]
+            yield i2o, o2i, ilen, olen
+
+    def test_grow(self):
+        for i2o, o2i, ilen, olen in self._random_cases():
+            self.assertEqual(_scan_grow(i2o, o2i, ilen, olen, alignment._neighboring_points_orthogonal),
+                             alignment.sym_grow(i2o, o2i, ilen, olen))
+
+    def test_grow_diagonal(self):
+        for i2o, o2i, ilen, olen in self._random_cases():
+            self.assertEqual(_scan_grow_diagonal(i2o, o2i, ilen, olen),
+                             alignment.sym_grow_diagonal(i2o, o2i, ilen, olen))
+
+    def test_grow_diagonal_final_and(self):
+        for i2o, o2i, ilen, olen in self._random_cases():
+            expected = _scan_final(_scan_grow_diagonal(i2o, o2i, ilen, olen), i2o, o2i, ilen, olen)
+            self.assertEqual(expected, alignment.sym_grow_diagonal_final_and(i2o, o2i, ilen, olen))
+
+    def test_grow_diagonal_keeps_original_output(self):
+        # (1, 1) is only reachable diagonally from (0, 0): the original grow-diag did not add it
+        self.assertEqual([(0, 0)], alignment.sym_grow_diagonal([(0, 0), (1, 1)], [(0, 0)], 2, 2))
+        self.assertEqual([(0, 0)], alignment.sym_grow([(0, 0), (1, 1)], [(0, 0)], 2, 2))
+
+
+class MakeAlignmentsTest(unittest.TestCase):
+    @staticmethod
+    def _indexes(rnd, length):
+        # sub-token to token indexes: consecutive sub-tokens may belong to the same token
+        indexes = [0]
+        for _ in range(length - 1):
+            indexes.append(indexes[-1] + (1 if rnd.random() < .7 else 0))
+        return indexes
+
+    def _random_batch(self, rnd):
+        size = rnd.randint(1, 6)
+        batch_source_indexes, batch_target_indexes, matrices = [], [], []
+
+        for _ in range(size):
+            # single-token rows are frequent, the matrices are larger than the sentence (as the decoder attention)
+            source_length = rnd.choice([1, 1, rnd.randint(2, 12)])
+            target_length = rnd.choice([1, 1, rnd.randint(2, 12)])
+            matrix = torch.rand(source_length + rnd.randint(0, 2), target_length + rnd.randint(0, 2),
+                                generator=torch.Generator().manual_seed(rnd.randint(0, 1 << 30)))
+
+            batch_source_indexes.append(self._indexes(rnd, source_length))
+            batch_target_indexes.append(self._indexes(rnd, target_length))
+            matrices.append(matrix)
+
+        return batch_source_indexes, batch_target_indexes, matrices
+
+    def test_equals_make_alignment(self):
+        rnd = random.Random(1)
+        symmetrizations = [alignment.sym_intersect, alignment.sym_union, alignment.sym_grow_diagonal_final_and]
+
+        for _ in range(300):
+            batch_source_indexes, batch_target_indexes, matrices = self._random_batch(rnd)
+
+            for prefix_lang in (None, True):
+                for symmetrize in symmetrizations:
+                    result = alignment.make_alignments(batch_source_indexes, batch_target_indexes, matrices,
+                                                       prefix_lang=prefix_lang, symmetrize=symmetrize)
+                    expected = [alignment.make_alignment(source_indexes, target_indexes, matrix.numpy(),
+                                                         prefix_lang=prefix_lang, symmetrize=symmetrize)
+                                for source_indexes, target_indexes, matrix
+                                in zip(batch_source_indexes, batch_target_indexes, matrices)]
+
+                    self.assertEqual(expected, result)
+
+    def test_empty_batch(self):
+        self.assertEqual([], alignment.make_alignments([], [], []))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import os
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir,
+                                'src', 'decoder-neural', 'src', 'main', 'python'))
+
+from mmt.decoder import Translation
+from mmt.utils import TranslationResponse
+
+
+class BinaryResponseTest(unittest.TestCase):
+    def test_translations(self):
+        alignment = [(0, 0), (70000, 1), (2, 1 << 20)]
+        data = TranslationResponse.to_bytes([Translation('ciao', alignment=alignment, score=.5),
+                                             Translation('mondo')])
+
+        expected = b'\x01' + struct.pack('>I', 2) + \
+            struct.pack('>I', 4) + b'ciao' + struct.pack('>Bf', 3, .5) + \
+            struct.pack('>I3I3I', 3, 0, 70000, 2, 0, 1, 1 << 20) + \
+            struct.pack('>I', 5) + b'mondo' + struct.pack('>B', 0)
+        self.assertEqual(expected, data)
+
+    def test_error(self):
+        data = TranslationResponse.to_bytes(ValueError('bad'))
+
+        expected = b'\x00' + struct.pack('>I', 10) + b'ValueError' + struct.pack('>I', 3) + b'bad'
+        self.assertEqual(expected, data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir,
+                                'src', 'decoder-neural', 'src', 'main', 'python'))
+
+from mmt.cache import TranslationCache, TranslationStore
+from mmt.decoder import Translation
+
+
+def _key(segment, beam_size=None):
+    return TranslationCache.key('checkpoint', 'en', 'it', segment, beam_size)
+
+
+def _texts(translations):
+    return [translation.text if translation is not None else None for translation in translations]
+
+
+class TranslationCacheTest(unittest.TestCase):
+    def test_lru(self):
+        cache = TranslationCache(2)
+        cache.put_all([(_key('a'), Translation('A', alignment=[])), (_key('b'), Translation('B', alignment=[]))])
+
+        self.assertEqual(['A'], _texts(cache.get_all([_key('a')])))  # 'b' is now the least recently used
+
+        cache.put_all([(_key('c'), Translation('C', alignment=[]))])
+        self.assertEqual(2, len(cache))
+        self.assertEqual(['A', None, 'C'], _texts(cache.get_all([_key('a'), _key('b'), _key('c')])))
+
+    def test_key(self):
+        cache = TranslationCache(10)
+        cache.put_all([(_key('a'), Translation('A', alignment=[]))])
+
+        self.assertEqual(_key('a'), _key('a', beam_size=0))
+        self.assertEqual([None], _texts(cache.get_all([_key('a', beam_size=1)])))
+        self.assertEqual([None], _texts(cache.get_all([TranslationCache.key('checkpoint', 'en', 'fr', 'a')])))
+
+    def test_alignment(self):
+        cache = TranslationCache(10)
+        cache.put_all([(_key('a'), Translation('A')), (_key('b'), Translation('B', alignment=[(0, 0)], score=.5))])
+
+        # an entry without alignment does not answer a request with alignment
+        self.assertEqual([None, 'B'], _texts(cache.get_all([_key('a'), _key('b')], alignment=True)))
+
+        # an entry with alignment answers a request without it, the alignment is stripped
+        a, b = cache.get_all([_key('a'), _key('b')], alignment=False)
+        self.assertEqual(('A', None), (a.text, a.alignment))
+        self.assertEqual(('B', None, .5), (b.text, b.alignment, b.score))
+
+        # the entry is upgraded by a translation with alignment, never downgraded
+        cache.put_all([(_key('a'), Translation('A', alignment=[(1, 1)]))])
+        cache.put_all([(_key('b'), Translation('B'))])
+        a, b = cache.get_all([_key('a'), _key('b')])
+        self.assertEqual([(1, 1)], a.alignment)
+        self.assertEqual([(0, 0)], b.alignment)
+
+    def test_counters(self):
+        cache = TranslationCache(10)
+        cache.put_all([(_key('a'), Translation('A', alignment=[]))])
+
+        # repeated segments are counted once per batch
+        cache.get_all([_key('a'), _key('b'), _key('a'), _key('b'), _key('c')])
+        self.assertEqual((1, 2, 0), (cache.hits, cache.misses, cache.store_hits))
+        self.assertAlmostEqual(1. / 3, cache.hit_rate)
+
+        cache.get_all([_key('a'), _key('a')])
+        self.assertEqual((2, 2), (cache.hits, cache.misses))
+
+    def test_empty(self):
+        cache = TranslationCache(10)
+
+        self.assertEqual([], cache.get_all([]))
+        self.assertEqual(0., cache.hit_rate)
+        self.assertEqual(0, len(cache))
+
+    def test_disabled_memory(self):
+        cache = TranslationCache(None)
+        cache.put_all([(_key('a'), Translation('A', alignment=[]))])
+
+        self.assertEqual([None], _texts(cache.get_all([_key('a')])))
+        self.assertEqual(0, len(cache))
+
+
+class _Checkpoint(object):
+    def __init__(self, path):
+        self.path = path
+
+
+class TranslationStoreTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self._tmp.name, 'cache.db')
+        self.checkpoint = _Checkpoint(os.path.join(self._tmp.name, 'checkpoint'))
+
+        os.makedirs(self.checkpoint.path)
+        with open(os.path.join(self.checkpoint.path, 'model.pt'), 'wb') as f:
+            f.write(b'weights')
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _store(self, **kwargs):
+        store = TranslationStore(self.db_path, Translation, **kwargs)
+        self.addCleanup(store.close)
+        return store
+
+    def _key(self, segment):
+        return TranslationCache.key(self.checkpoint, 'en', 'it', segment)
+
+    def _put(self, store, *segments):
+        store.put_all([(self._key(segment), Translation(segment.upper(), alignment=[(0, 0)], score=.5))
+                       for segment in segments])
+
+    def _get(self, store, *segments):
+        translations = store.get_all([self._key(segment) for segment in segments])
+        return sorted(key[-1] for key in translations)
+
+    def test_reopen(self):
+        store = self._store(signature=[5])
+        self._put(store, 'a', 'b')
+        store.close()
+
+        store = self._store(signature=[5])
+        self.assertEqual(['a', 'b'], self._get(store, 'a', 'b', 'c'))
+
+        translation = store.get_all([self._key('a')])[self._key('a')]
+        self.assertEqual(('A', [(0, 0)], .5), (translation.text, translation.alignment, translation.score))
+
+        with sqlite3.connect(self.db_path) as connection:
+            self.assertEqual('wal', connection.execute('PRAGMA journal_mode').fetchone()[0])
+
+    def test_signature_change(self):
+        store = self._store(signature=[5, False])
+        self._put(store, 'a')
+        store.close()
+
+        self.assertEqual([], self._get(self._store(signature=[1, False]), 'a'))
+        self.assertEqual(['a'], self._get(self._store(signature=[5, False]), 'a'))
+
+    def test_checkpoint_change(self):
+        store = self._store()
+        self._put(store, 'a')
+        store.close()
+
+        with open(os.path.join(self.checkpoint.path, 'model.pt'), 'ab') as f:
+            f.write(b' updated')
+
+        self.assertEqual([], self._get(self._store(), 'a'))
+
+    def test_checkpoint_moved(self):
+        store = self._store()
+        self._put(store, 'a')
+        store.close()
+
+        path = self.checkpoint.path + '.moved'
+        os.rename(self.checkpoint.path, path)
+        self.checkpoint = _Checkpoint(path)
+
+        self.assertEqual([], self._get(self._store(), 'a'))
+
+    def test_eviction(self):
+        store = self._store(max_entries=3)
+        store._EVICTION_INTERVAL = 4
+
+        self._put(store, 'a', 'b', 'c')
+        self.assertEqual(['a'], self._get(store, 'a'))  # 'b' and 'c' are now the least recently accessed
+
+        self._put(store, 'd', 'e')  # 5 entries: evicted down to 3
+        self.assertEqual(['a', 'd', 'e'], self._get(store, 'a', 'b', 'c', 'd', 'e'))
+
+    def test_no_eviction_without_max_entries(self):
+        store = self._store()
+        store._EVICTION_INTERVAL = 1
+
+        self._put(store, 'a', 'b', 'c')
+        self.assertEqual(['a', 'b', 'c'], self._get(store, 'a', 'b', 'c'))
+
+
+if __name__ == '__main__':
+    unittest.main()
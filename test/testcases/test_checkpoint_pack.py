@@ -0,0 +1,49 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir,
+                                'src', 'decoder-neural', 'src', 'main', 'python'))
+
+import torch
+
+from mmt import SubwordDictionary
+from mmt.checkpoint import CheckpointRegistry
+
+
+def _make_checkpoint(path):
+    os.makedirs(path)
+
+    dictionary = SubwordDictionary.build_from_token_counts({'hello': 10, 'world': 10}, 1, num_iterations=1)
+    dictionary.save(os.path.join(path, 'model.vcb'))
+
+    torch.save({'args': None, 'model': {'encoder.embed_tokens.weight': torch.ones(len(dictionary), 4)}},
+               os.path.join(path, 'model.pt'))
+
+
+class PackTest(unittest.TestCase):
+    def test_colliding_basenames(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            builder = CheckpointRegistry.Builder()
+            for i, path in enumerate([os.path.join(tmp, 'a', 'x'), os.path.join(tmp, 'b', 'x_2'),
+                                      os.path.join(tmp, 'c', 'x'), os.path.join(tmp, 'd', 'x')]):
+                _make_checkpoint(path)
+                builder.register('en__l%d' % i, path)
+
+            bundle_path = os.path.join(tmp, 'bundle')
+            builder.pack(bundle_path)
+
+            with open(os.path.join(bundle_path, CheckpointRegistry.BUNDLE_MANIFEST), encoding='utf-8') as f:
+                manifest = json.load(f)
+
+            paths = [entry['path'] for entry in manifest['checkpoints']]
+            self.assertEqual(['x', 'x_2', 'x_3', 'x_4'], paths)
+
+            for path in paths:
+                self.assertTrue(os.path.isfile(os.path.join(bundle_path, path, 'model.idx')))
+
+
+if __name__ == '__main__':
+    unittest.main()
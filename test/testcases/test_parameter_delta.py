@@ -0,0 +1,86 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir,
+                                'src', 'decoder-neural', 'src', 'main', 'python'))
+
+import torch
+
+from mmt.tuning import ParameterDelta
+
+
+class _TiedModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.embed = torch.nn.Embedding(10, 8)
+        self.hidden = torch.nn.Linear(8, 8)
+        self.output = torch.nn.Linear(8, 10, bias=False)
+        self.output.weight = self.embed.weight
+
+    def forward(self, tokens):
+        return self.output(torch.tanh(self.hidden(self.embed(tokens))))
+
+
+def _loss(model, tokens):
+    return torch.nn.functional.cross_entropy(model(tokens), tokens)
+
+
+class ParameterDeltaTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(1)
+        self.model = _TiedModel()
+        self.tokens = torch.tensor([1, 2, 3, 4])
+
+    def _train(self, delta, steps=5):
+        optimizer = torch.optim.SGD(delta.parameters(), lr=1.)
+        for _ in range(steps):
+            optimizer.zero_grad()
+            delta.apply(_loss, self.model, self.tokens).backward()
+            optimizer.step()
+
+    def test_zero_delta_is_base(self):
+        delta = ParameterDelta(self.model, [name for name, _ in self.model.named_parameters()])
+
+        with torch.no_grad():
+            self.assertTrue(torch.equal(self.model(self.tokens), delta.apply(self.model, self.tokens)))
+
+    def test_base_is_not_modified(self):
+        expected = {name: p.detach().clone() for name, p in self.model.named_parameters()}
+
+        delta = ParameterDelta(self.model, [name for name, _ in self.model.named_parameters()])
+        before = _loss(self.model, self.tokens).item()
+        self._train(delta)
+
+        for name, p in self.model.named_parameters():
+            self.assertTrue(torch.equal(expected[name], p), name)
+            self.assertIsNone(p.grad, name)
+
+        with torch.no_grad():
+            self.assertLess(delta.apply(_loss, self.model, self.tokens).item(), before)
+            self.assertEqual(before, _loss(self.model, self.tokens).item())
+
+    def test_tied_parameters(self):
+        # the shared weight is reachable under both names, both must see the same delta
+        delta = ParameterDelta(self.model, ['embed.weight'])
+        self._train(delta)
+
+        def _weights(model):
+            return model.embed.weight, model.output.weight
+
+        embed, output = delta.apply(_weights, self.model)
+        self.assertTrue(torch.equal(embed, output))
+        self.assertFalse(torch.equal(self.model.embed.weight, embed))
+
+    def test_deltas_are_independent(self):
+        names = ['hidden.weight', 'hidden.bias']
+        first, second = ParameterDelta(self.model, names), ParameterDelta(self.model, names)
+        self._train(first)
+
+        with torch.no_grad():
+            self.assertTrue(torch.equal(self.model(self.tokens), second.apply(self.model, self.tokens)))
+            self.assertFalse(torch.equal(self.model(self.tokens), first.apply(self.model, self.tokens)))
+
+
+if __name__ == '__main__':
+    unittest.main()
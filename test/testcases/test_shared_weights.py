@@ -0,0 +1,94 @@
+import multiprocessing
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir,
+                                'src', 'decoder-neural', 'src', 'main', 'python'))
+
+import torch
+
+from mmt.decoder import _load_shared_state, _share_tensor
+
+
+def _build_model():
+    return torch.nn.Sequential(torch.nn.Linear(64, 64), torch.nn.BatchNorm1d(64), torch.nn.Linear(64, 8))
+
+
+def _build_state():
+    torch.manual_seed(1)
+    state = _build_model().state_dict()
+    return {name: torch.randn_like(tensor) if tensor.is_floating_point() else tensor
+            for name, tensor in state.items()}
+
+
+def _worker_pointers(connection, state):
+    model = _build_model()
+    _load_shared_state(model, state)
+    connection.send([(name, p.data_ptr()) for name, p in model.named_parameters()])
+
+
+class SharedWeightsTest(unittest.TestCase):
+    def test_parameters_are_views(self):
+        state = _build_state()
+        model = _build_model()
+        _load_shared_state(model, state)
+
+        for name, parameter in model.named_parameters():
+            self.assertEqual(state[name].data_ptr(), parameter.data_ptr(), name)
+
+        # buffers are copied
+        self.assertNotEqual(state['1.running_mean'].data_ptr(), model[1].running_mean.data_ptr())
+        self.assertTrue(torch.equal(state['1.running_mean'], model[1].running_mean))
+
+    def test_restore_drops_copy(self):
+        state = _build_state()
+        model = _build_model()
+        _load_shared_state(model, state)
+
+        weight = model[0].weight
+        expected = state['0.weight'].clone()
+
+        weight.data = weight.data.clone()  # copy on write, as the tuner does
+        with torch.no_grad():
+            weight.add_(1.)
+
+        self.assertTrue(torch.equal(expected, state['0.weight']))
+
+        with torch.no_grad():
+            _share_tensor(weight, state['0.weight'])
+        self.assertEqual(state['0.weight'].data_ptr(), weight.data_ptr())
+
+    def test_mismatching_dtype_is_copied(self):
+        state = _build_state()
+        model = _build_model().double()
+        _load_shared_state(model, state)
+
+        self.assertNotEqual(state['0.weight'].data_ptr(), model[0].weight.data_ptr())
+        self.assertTrue(torch.equal(state['0.weight'].double(), model[0].weight))
+
+    def test_missing_keys(self):
+        state = _build_state()
+        del state['0.bias']
+
+        with self.assertRaises(RuntimeError):
+            _load_shared_state(_build_model(), state)
+
+    def test_forked_workers_share_state(self):
+        state = _build_state()
+        context = multiprocessing.get_context('fork')
+
+        for _ in range(3):
+            parent_connection, child_connection = context.Pipe()
+            process = context.Process(target=_worker_pointers, args=(child_connection, state))
+            process.start()
+
+            pointers = parent_connection.recv()
+            process.join()
+
+            for name, pointer in pointers:
+                self.assertEqual(state[name].data_ptr(), pointer, name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import os
+import random
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir,
+                                'src', 'decoder-neural', 'src', 'main', 'python'))
+
+from fairseq.data import Dictionary
+
+from mmt import textencoder
+from mmt.textencoder import SubwordDictionary
+
+
+# Reference implementation: greedy segmentation by decreasing length, before the trie
+
+def _scan_subtokens_of(dictionary, token):
+    escaped_token = textencoder._escape_token(token, dictionary._alphabet)
+
+    ret = []
+    start = 0
+    token_len = len(escaped_token)
+    while start < token_len:
+        for end in range(min(token_len, start + dictionary._max_subtoken_len), start, -1):
+            subtoken = escaped_token[start:end]
+            if subtoken in dictionary.indices:
+                ret.append(subtoken)
+                start = end
+                break
+        else:  # Did not break
+            return [dictionary.unk_string()]
+
+    return ret
+
+
+def _scan_tokenize(dictionary, raw_text):
+    ret = []
+    for token in raw_text.strip().split():
+        ret.extend(_scan_subtokens_of(dictionary, token))
+    return ret
+
+
+_WORDS = ['hello', 'world', 'hell', 'low', 'lower', 'the', 'cat', 'is', 'on', 'table', 'snake_case', 'a\\b',
+          'caffè', 'naïve', '12;3', 'u_u', '[[it]]']
+
+_LINES = ['hello world', '  the   lower cat  ', 'snake_case a\\b_c', 'caffè naïve €', 'hellooo wwworld', '',
+          '12;3 \\u_ \\\\', 'a 日本 b', '[[it]] hello', 'ħ']
+
+
+def _random_lines(count=300):
+    rnd = random.Random(1)
+    chars = 'helowrdtcaisnb_\\;0123456789uè€日ħ'
+    for _ in range(count):
+        words = [rnd.choice(_WORDS) if rnd.random() < .5 else
+                 ''.join(rnd.choice(chars) for _ in range(rnd.randint(1, 8))) for _ in range(rnd.randint(0, 6))]
+        yield ' '.join(words)
+
+
+def _dictionaries():
+    counts = {word: 10 - i % 5 for i, word in enumerate(_WORDS)}
+    yield SubwordDictionary.build_from_token_counts(counts, 2, num_iterations=2,
+                                                    reserved_tokens=textencoder.RESERVED_TOKENS)
+
+    # escaping characters are in the alphabet, but not all of them are subtokens: tokens with
+    # characters out of the alphabet cannot be encoded and are mapped to the unknown symbol
+    yield SubwordDictionary(textencoder.RESERVED_TOKENS + ['hel', 'hello_', 'lo', 'wor', 'ld_', 'h', 'e', 'l', 'o',
+                                                           'w', 'r', 'd', '_', '\\', 'u', 'the_', 'cat_'])
+
+
+class TrieSegmentationTest(unittest.TestCase):
+    def test_tokenize(self):
+        for dictionary in _dictionaries():
+            for line in _LINES + list(_random_lines()):
+                expected = _scan_tokenize(dictionary, line)
+                self.assertEqual(expected, dictionary.tokenize(line), line)
+                self.assertEqual([dictionary.index(s) for s in expected], dictionary.tokenize_ids(line), line)
+
+    def test_unknown(self):
+        dictionary = list(_dictionaries())[1]
+
+        for line in ['日本', 'hello 日本 world', 'caffè']:
+            self.assertIn(textencoder.UNK, _scan_tokenize(dictionary, line))
+            self.assertEqual(_scan_tokenize(dictionary, line), dictionary.tokenize(line))
+            self.assertIn(dictionary.unk_index, dictionary.tokenize_ids(line))
+
+    def test_encode_line(self):
+        for dictionary in _dictionaries():
+            for line in _LINES + list(_random_lines()):
+                for append_eos in (True, False):
+                    for reverse_order in (True, False):
+                        expected = Dictionary.encode_line(dictionary, line,
+                                                          line_tokenizer=lambda l: _scan_tokenize(dictionary, l),
+                                                          add_if_not_exist=False, append_eos=append_eos,
+                                                          reverse_order=reverse_order)
+                        ids = dictionary.encode_line(line, line_tokenizer=dictionary.tokenize, add_if_not_exist=False,
+                                                     append_eos=append_eos, reverse_order=reverse_order)
+
+                        self.assertEqual(expected.dtype, ids.dtype)
+                        self.assertEqual(expected.tolist(), ids.tolist(), line)
+
+    def test_encode_line_other_tokenizer(self):
+        dictionary = list(_dictionaries())[0]
+        words = []
+
+        ids = dictionary.encode_line('hello world', line_tokenizer=dictionary.tokenize, add_if_not_exist=False,
+                                     consumer=lambda word, idx: words.append(word))
+        self.assertEqual(dictionary.tokenize('hello world'), words)
+        self.assertEqual(dictionary.tokenize_ids('hello world') + [dictionary.eos_index], ids.tolist())
+
+    def test_concurrent_tokenize(self):
+        lines = list(_random_lines(100))
+        dictionary = list(_dictionaries())[0]
+        expected = [_scan_tokenize(dictionary, line) for line in lines]
+
+        results, errors = {}, []
+
+        def _run(worker):
+            try:
+                results[worker] = [dictionary.tokenize(line) for line in lines]
+            except BaseException as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=_run, args=(worker,)) for worker in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([], errors)
+        for worker in range(8):
+            self.assertEqual(expected, results[worker])
+
+    def test_cached_results_are_not_modified(self):
+        dictionary = list(_dictionaries())[0]
+        expected = dictionary.tokenize_ids('hello')
+
+        ids = dictionary.tokenize_ids('hello hello')
+        self.assertEqual(expected + expected, ids)
+        self.assertEqual(expected, dictionary.tokenize_ids('hello'))
+
+
+if __name__ == '__main__':
+    unittest.main()